@@ -1,25 +1,128 @@
+import argparse
 import asyncio
-from asyncio import StreamReader, StreamWriter
+from typing import Dict
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-async def dispatch(reader: StreamReader, writer: StreamWriter):
-    addr = writer.get_extra_info('peername')
-    while True:
-        data = await reader.read(2048)
 
-        if data and data != b"exit\n":
-            writer.write(data)
-            print('{} sent: {}'.format(addr, data))
-        else:
-            await writer.drain()
-            writer.close()
+class EchoServer:
+    """
+    Settings and counters shared by the connections of one echo server.
+
+    Reads are `read_size` bytes at most, and a connection stops reading
+    while more than `high_water` bytes wait to be sent to its client, until
+    that drops below `low_water`. So a client that sends faster than it reads
+    only ever costs the server its write buffer. Connections beyond
+    `max_connections` are closed right away.
+    """
+
+    def __init__(self, read_size: int = 64 * 1024, high_water: int = 256 * 1024, low_water: int = 64 * 1024,
+                 max_connections: int = 1000):
+        self.read_size = read_size
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_connections = max_connections
+
+        self.connections = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.pauses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'connections': self.connections,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'bytes': self.bytes,
+            'pauses': self.pauses,
+        }
+
+
+class EchoProtocol(asyncio.BufferedProtocol):
+    """
+    Sends back everything it receives, until the client sends "exit\\n" or
+    closes its side.
+
+    Data is received straight into a buffer that is reused for the next read,
+    unless the transport could not send it all and kept a reference to it, in
+    which case a new one is allocated. Reading is paused while the write
+    buffer is above the high water mark, which is what drain() does for
+    streams, without a coroutine per write.
+    """
+
+    def __init__(self, server: EchoServer):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray(server.read_size)
+        self.view = memoryview(self.buffer)
+        self.counted = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.server.connections >= self.server.max_connections:
+            self.server.rejected += 1
+            transport.abort()
             return
+        self.counted = True
+        self.server.connections += 1
+        self.server.accepted += 1
+        transport.set_write_buffer_limits(self.server.high_water, self.server.low_water)
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        data = self.view[:nbytes]
+        if data == b'exit\n':
+            self.transport.close()
+            return
+
+        self.server.bytes += nbytes
+        self.transport.write(data)
+        if self.transport.get_write_buffer_size():
+            self.buffer = bytearray(self.server.read_size)
+            self.view = memoryview(self.buffer)
+
+    def eof_received(self):
+        # returning False closes the connection once everything was sent back
+        return False
+
+    def pause_writing(self):
+        self.server.pauses += 1
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if self.counted:
+            self.server.connections -= 1
 
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(dispatch, '127.0.0.1', 5555, loop=loop)
-    server = loop.run_until_complete(coro)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--read-size', type=int, default=64 * 1024, help='bytes read from a socket at once')
+    parser.add_argument('--high-water', type=int, default=256 * 1024,
+                        help='stop reading from a client with this many bytes waiting to be sent to it')
+    parser.add_argument('--low-water', type=int, default=64 * 1024,
+                        help='resume reading once no more than this many bytes wait')
+    parser.add_argument('--max-connections', type=int, default=1000)
+    parser.add_argument('--no-uvloop', action='store_true', help='use the asyncio event loop even if uvloop is installed')
+    args = parser.parse_args()
+
+    if uvloop is not None and not args.no_uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    echo = EchoServer(args.read_size, args.high_water, args.low_water, args.max_connections)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(loop.create_server(lambda: EchoProtocol(echo), args.host, args.port))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -27,3 +130,4 @@ if __name__ == '__main__':
     server.close()
     loop.run_until_complete(server.wait_closed())
     loop.close()
+    print(echo.stats())
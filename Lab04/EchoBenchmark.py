@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import time
+from typing import List, Tuple
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+async def stream(host: str, port: int, size: int, duration: float) -> int:
+    """Send as fast as the server echoes back for `duration` seconds, returns the bytes echoed."""
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = b'x' * size
+    deadline = time.perf_counter() + duration
+
+    async def send():
+        while time.perf_counter() < deadline:
+            writer.write(payload)
+            await writer.drain()
+        writer.write_eof()
+
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+    await sender
+    writer.close()
+    return received
+
+
+async def ping(host: str, port: int, size: int, duration: float) -> List[float]:
+    """One message at a time, returns the round trip time of each."""
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = b'x' * size
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        begin = time.perf_counter()
+        writer.write(payload)
+        await reader.readexactly(size)
+        latencies.append(time.perf_counter() - begin)
+    writer.close()
+    return latencies
+
+
+def describe(latencies: List[float]) -> Tuple[float, float, float, float]:
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return tuple(latencies[min(n - 1, int(n * fraction))] * 1000 for fraction in (0.5, 0.99, 0.999, 1.0))
+
+
+async def main(args: argparse.Namespace):
+    begin = time.perf_counter()
+    received = await asyncio.gather(*[stream(args.host, args.port, args.size, args.duration)
+                                      for _ in range(args.connections)])
+    elapsed = time.perf_counter() - begin
+    print('throughput: {} connections, {:.1f} MB/s, {:.0f} messages/sec'.format(
+        args.connections, sum(received) / elapsed / 1e6, sum(received) / args.size / elapsed))
+
+    results = await asyncio.gather(*[ping(args.host, args.port, args.ping_size, args.duration)
+                                     for _ in range(args.connections)])
+    latencies = [it for result in results for it in result]
+    print('latency: {} connections, {:.0f} round trips/sec, p50 {:.3f} ms, p99 {:.3f} ms, '
+          'p999 {:.3f} ms, max {:.3f} ms'.format(args.connections, len(latencies) / args.duration,
+                                                 *describe(latencies)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput and latency of the echo server in Echo.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--size', type=int, default=16 * 1024, help='bytes per write when measuring throughput')
+    parser.add_argument('--ping-size', type=int, default=64, help='bytes per message when measuring latency')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of each measurement')
+    parser.add_argument('--no-uvloop', action='store_true')
+    args = parser.parse_args()
+
+    if uvloop is not None and not args.no_uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main(args))
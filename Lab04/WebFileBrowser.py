@@ -1,11 +1,18 @@
+import argparse
 import asyncio
 import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
 from mimetypes import MimeTypes
 from urllib.parse import unquote
-from typing import Tuple
+from typing import Any, BinaryIO, Callable, Tuple
 from typing import Dict
 from asyncio import StreamReader, StreamWriter
 
+from common import DirListing
+from common.FileCache import FileCache
+from common.HttpParser import RequestParser, HttpParseError, error_page
+
 err404 = [b'HTTP/1.0 404 Not Found\r\n'
           b'Connection: close\r\n'
           b'Content-Type:text/html; charset=utf-8\r\n'
@@ -23,12 +30,35 @@ err405 = [b'HTTP/1.0 405 Method Not Allowed\r\n'
 # the root dir map to web page
 mappingDir = "."
 
+mime = MimeTypes()
+
+# small static files are served from memory, see FileCache
+file_cache = FileCache()
+
+# blocking file system calls run here, never on the event loop
+executor = ThreadPoolExecutor(max_workers=8)
+# bigger files are streamed in chunks of this size when sendfile is not available
+chunk_size = 256 * 1024
+
+
+async def blocking(func: Callable, *args) -> Any:
+    return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+
 
 async def dispatch(reader: StreamReader, writer: StreamWriter):
-    # we assume that a request not bigger than 128k
-    # otherwise, my program may throw exception and cannot sever correctly
-    data = await reader.read(128 * 1024)
-    request = decode_request(data)
+    parser = RequestParser()
+    try:
+        requests = []
+        while not requests:
+            data = await reader.read(64 * 1024)
+            if not data:
+                writer.close()
+                return
+            requests = parser.feed(data)
+    except HttpParseError as e:
+        await write(error_page(e), writer)
+        return
+    request = requests[0]
     method, uri, query, header = request
 
     if method != 'GET' and method != 'HEAD':
@@ -37,42 +67,25 @@ async def dispatch(reader: StreamReader, writer: StreamWriter):
 
     rel_uri = uri[1:] if uri[0] == '/' else uri
     path = os.path.join(mappingDir, unquote(rel_uri))
-    if not os.path.exists(path):
+
+    # the cache only stats a file once per revalidation interval, in the executor as well
+    cached = await blocking(file_cache.get, path)
+    if cached is not None:
+        head, body = cached
+        await write(head if method == "HEAD" else head + body, writer)
+        return
+
+    try:
+        st = await blocking(os.stat, path)
+    except OSError:
         await write(err404, writer)
-    elif os.path.isdir(path):
+        return
+    if stat.S_ISDIR(st.st_mode):
         await handleDir(request, writer)
     else:
         await handleFile(request, writer)
 
 
-def decode_request(data: bytes) -> Tuple[str, str, str, Dict[str, str]]:
-    data = data.decode().split('\r\n')
-    method: str
-    uri: str
-    method, uri, _ = data[0].split()
-
-    query: str = ''
-    if '?' in uri:
-        index = uri.index('?')
-        query = uri[index + 1:]
-        uri = uri[:index]
-
-    header = {}
-
-    # print(data[0])
-    for line in data[1:]:
-        # print(line)
-        if not line:
-            # when the line is empty, header is end
-            break
-        index = line.index(":")
-        name: str = line[0: index]
-        value: str = line[index + 1:]
-        header[name.strip().lower()] = value.strip()
-
-    return method, uri, query, header
-
-
 async def write(data: bytes, writer: StreamWriter):
     writer.write(data)
     await writer.drain()
@@ -95,26 +108,19 @@ async def handleDir(request: Tuple[str, str, str, Dict[str, str]], writer: Strea
         await write(data, writer)
         return
 
-    data += b'<html>\r\n'
-    data += '<head><title>Index of /{}</title></head>\r\n'.format(unquote_uri).encode('utf-8')
-    data += b'<body bgcolor="white">\r\n'
-    data += '<h1>Index of /{}</h1><hr><pre>\r\n'.format(unquote_uri).encode('utf-8')
-
-    if uri == '/':
-        data += '<a href="/">..</a>\r\n'.encode('utf-8')
-    else:
-        data += '<a href="../">..</a>\r\n'.encode('utf-8')
+    data += await blocking(DirListing.render, path, uri, unquote_uri, query)
 
-    for it in os.listdir(path):
-        abs_path = os.path.join(path, it)
-        if os.path.isdir(abs_path):
-            it += '/'
-        data += '<a href="{}">{}</a>\r\n'.format(it, it).encode('utf-8')
+    await write(data, writer)
 
-    data += b'</pre><hr></body>\r\n'
-    data += b'</html>\r\n'
 
-    await write(data, writer)
+def open_file(path: str) -> Tuple[BinaryIO, os.stat_result]:
+    file = open(path, 'rb')
+    try:
+        # the signature of the open file, a file replaced after this is never cached under it
+        return file, os.fstat(file.fileno())
+    except OSError:
+        file.close()
+        raise
 
 
 async def handleFile(request: Tuple[str, str, str, Dict[str, str]], writer: StreamWriter):
@@ -124,35 +130,74 @@ async def handleFile(request: Tuple[str, str, str, Dict[str, str]], writer: Stre
     unquote_uri = unquote(rel_uri)
     path = os.path.join(mappingDir, unquote_uri)
 
-    mine = MimeTypes()
-    guess = mine.guess_type(path)
-    if not guess:
-        mine_type = "application/octet-stream"
-    else:
-        mine_type, _ = guess
+    guess = mime.guess_type(path)
+    mine_type = guess[0] or "application/octet-stream"
 
-    content_length = os.path.getsize(path)
+    try:
+        file, st = await blocking(open_file, path)
+    except OSError:
+        await write(err404, writer)
+        return
 
     data = b'HTTP/1.0 200 OK\r\n'
     data += b'Connection: close\r\n'
     data += 'Content-Type: {}\r\n'.format(mine_type).encode('utf-8')
-    data += 'Content-Length: {}\r\n'.format(content_length).encode('utf-8')
+    data += 'Content-Length: {}\r\n'.format(st.st_size).encode('utf-8')
     data += b'\r\n'
 
     if method == "HEAD":
+        file.close()
         await write(data, writer)
         return
 
-    file = open(path, 'rb')
-    data += file.read()
-    file.close()
+    try:
+        if st.st_size <= file_cache.max_file_size:
+            body = await blocking(file.read)
+            file_cache.put(path, st, (data, body), len(data) + len(body))
+            await write(data + body, writer)
+            return
+
+        writer.write(data)
+        await writer.drain()
+        await send(file, st.st_size, writer)
+    except ConnectionError:
+        pass
+    finally:
+        file.close()
+    writer.close()
 
-    await write(data, writer)
+
+async def send(file: BinaryIO, size: int, writer: StreamWriter):
+    """
+    Stream a file to the client. sendfile(2) copies it in the kernel without
+    it passing through Python, where that is not available (e.g. TLS) it is
+    read in the executor chunk by chunk, each written only once the previous
+    one has been drained.
+    """
+    try:
+        await asyncio.get_event_loop().sendfile(writer.transport, file, 0, size, fallback=False)
+        return
+    except asyncio.SendfileNotAvailableError:
+        pass
+
+    file.seek(0)
+    remaining = size
+    while remaining > 0:
+        chunk = await blocking(file.read, min(chunk_size, remaining))
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+        remaining -= len(chunk)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
     loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(dispatch, '127.0.0.1', 8080, loop=loop)
+    coro = asyncio.start_server(dispatch, '127.0.0.1', args.port)
     server = loop.run_until_complete(coro)
     try:
         loop.run_forever()
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import random
+import sys
+import time
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Tuple
+
+import dns.message
+import dns.rdataclass
+import dns.rdatatype
+import dns.zone
+
+from . import LocalResolver
+from .StubUpstream import load_zone, start_stub
+
+
+def make_zone(origin: str, names: int, ttl: int) -> str:
+    """Zone text with `names` hosts host0 .. hostN-1, each with one address."""
+    lines = [
+        '$ORIGIN {}'.format(origin),
+        '$TTL {}'.format(ttl),
+        '@ IN SOA ns hostmaster 1 3600 600 86400 30',
+        '@ IN NS ns',
+        'ns IN A 10.255.255.1',
+    ]
+    lines.extend('host{} IN A 10.{}.{}.{}'.format(i, i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(names))
+    return '\n'.join(lines) + '\n'
+
+
+def zone_names(zone: dns.zone.Zone) -> List[str]:
+    """Names of the zone that have an address, in zone file order of their node."""
+    return [name.to_text() for name, node in zone.nodes.items()
+            if node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.A) is not None]
+
+
+def zipf_weights(n: int, s: float) -> List[float]:
+    """Cumulative weights of ranks 1 .. n, the k-th most popular is asked 1 / k^s as often as the first."""
+    weights = []
+    total = 0.0
+    for k in range(1, n + 1):
+        total += 1 / k ** s
+        weights.append(total)
+    return weights
+
+
+def run_server(zone_text: str, delay: float, conn: Connection):
+    """
+    Stub upstream and resolver in their own process, so that the load
+    generator does not share a core with them. The resolver port is sent
+    through `conn`, and anything received on it stops the server, which then
+    sends back its statistics.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stub_transport, stub = loop.run_until_complete(start_stub(delay=delay, zone=dns.zone.from_text(
+        zone_text, relativize=False
+    )))
+    LocalResolver.upstream = LocalResolver.Upstream(stub_transport.get_extra_info('sockname'))
+    server_transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+        LocalResolver.DNSServerProtocol, local_addr=('127.0.0.1', 0)
+    ))
+    sweeper = loop.create_task(LocalResolver.sweep())
+
+    loop.add_reader(conn.fileno(), loop.stop)
+    conn.send(server_transport.get_extra_info('sockname'))
+    loop.run_forever()
+
+    conn.recv()
+    result = LocalResolver.stats()
+    result['upstream_queries'] = stub.queries
+    conn.send(result)
+    sweeper.cancel()
+    loop.run_until_complete(asyncio.gather(sweeper, return_exceptions=True))
+    server_transport.close()
+    stub_transport.close()
+    loop.close()
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        # send time of every query in flight by transaction ID
+        self.pending: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        self.lost = 0
+        self.elapsed = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        begin = self.pending.pop(int.from_bytes(data[0:2], byteorder='big'), None)
+        if begin is not None:
+            self.latencies.append(time.perf_counter() - begin)
+
+    def error_received(self, exc):
+        pass
+
+    def send(self, txid: int, wire: bytes):
+        # an ID still in flight after 65536 queries is given up on
+        if self.pending.pop(txid, None) is not None:
+            self.lost += 1
+        query = bytearray(wire)
+        query[0:2] = txid.to_bytes(2, byteorder='big')
+        self.pending[txid] = time.perf_counter()
+        self.transport.sendto(query)
+
+
+async def generate(server: Tuple[str, int], names: List[str], weights: List[float], qps: float,
+                   duration: float, timeout: float = 2.0, tick: float = 0.001) -> LoadProtocol:
+    """
+    Open loop load: queries go out at `qps` whatever the latency is, in small
+    batches every `tick`, so a slow server shows up as latency and loss
+    instead of a lower send rate.
+    """
+    loop = asyncio.get_event_loop()
+    _, client = await loop.create_datagram_endpoint(LoadProtocol, remote_addr=server)
+
+    count = int(qps * duration)
+    total = weights[-1]
+    draws = [bisect.bisect_left(weights, random.random() * total) for _ in range(count)]
+    wires: Dict[int, bytes] = {}
+
+    begin = time.perf_counter()
+    sent = 0
+    while sent < count:
+        due = min(count, int((time.perf_counter() - begin) * qps) + 1)
+        while sent < due:
+            rank = draws[sent]
+            wire = wires.get(rank)
+            if wire is None:
+                wire = wires[rank] = dns.message.make_query(names[rank], 'A').to_wire()
+            client.send(sent & 0xFFFF, wire)
+            sent += 1
+        await asyncio.sleep(tick)
+    client.elapsed = time.perf_counter() - begin
+
+    deadline = time.perf_counter() + timeout
+    while client.pending and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    client.lost += len(client.pending)
+    client.transport.close()
+    return client
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000 if latencies else 0.0
+
+
+def report(client: LoadProtocol, server_stats: Dict, qps: float) -> Dict:
+    latencies = sorted(client.latencies)
+    queries = server_stats['queries']
+    looked_up = queries['hits'] + queries['misses']
+    return {
+        'target_qps': qps,
+        'sent': len(client.latencies) + client.lost,
+        'answered': len(latencies),
+        'lost': client.lost,
+        'throughput': len(latencies) / client.elapsed,
+        'hit_ratio': queries['hits'] / looked_up if looked_up else 0.0,
+        'upstream_queries': server_stats['upstream_queries'],
+        'coalesced': server_stats['coalesce']['coalesced'],
+        'servfail': queries['servfail'],
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+        'max': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Zipf query load against LocalResolver with a local stub upstream')
+    parser.add_argument('--zone', metavar='PATH', help='zone file of the stub, by default one is generated')
+    parser.add_argument('--names', type=int, default=10000, help='hosts in the generated zone')
+    parser.add_argument('--ttl', type=int, default=300, help='TTL of the generated zone')
+    parser.add_argument('--delay', type=float, default=0.02, help='stub upstream latency in seconds')
+    parser.add_argument('--qps', type=float, default=2000)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load')
+    parser.add_argument('--zipf', type=float, default=1.0, help='exponent of the popularity distribution')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--min-throughput', type=float, default=0, help='fail below this many answers/sec')
+    parser.add_argument('--max-p99', type=float, default=0, help='fail above this p99 latency in ms')
+    parser.add_argument('--max-loss', type=float, default=0.01, help='fail above this fraction of lost queries')
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    if args.zone:
+        with open(args.zone) as f:
+            zone_text = f.read()
+        names = zone_names(load_zone(args.zone))
+    else:
+        zone_text = make_zone('bench.example.', args.names, args.ttl)
+        names = zone_names(dns.zone.from_text(zone_text, relativize=False))
+    # the generated zone lists hosts by number, which is also their popularity rank
+    names.sort(key=lambda name: (len(name), name))
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=run_server, args=(zone_text, args.delay, child_conn))
+    server.start()
+    address = conn.recv()
+
+    client = asyncio.run(generate(address, names, zipf_weights(len(names), args.zipf), args.qps, args.duration))
+    conn.send('stop')
+    result = report(client, conn.recv(), args.qps)
+    server.join()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('{sent} queries at {target_qps:.0f}/sec: {throughput:.0f} answers/sec, {lost} lost, '
+              'hit ratio {hit_ratio:.3f}, {upstream_queries} upstream queries, {servfail} SERVFAIL'.format(**result))
+        print('latency p50 {p50:.2f} ms, p99 {p99:.2f} ms, p999 {p999:.2f} ms, max {max:.2f} ms'.format(**result))
+
+    failures = []
+    if args.min_throughput and result['throughput'] < args.min_throughput:
+        failures.append('throughput {:.0f}/sec below {:.0f}'.format(result['throughput'], args.min_throughput))
+    if args.max_p99 and result['p99'] > args.max_p99:
+        failures.append('p99 {:.2f} ms above {:.2f}'.format(result['p99'], args.max_p99))
+    if result['sent'] and result['lost'] / result['sent'] > args.max_loss:
+        failures.append('{} of {} queries lost'.format(result['lost'], result['sent']))
+    for failure in failures:
+        print('FAIL:', failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import dns.message
+
+from . import LocalResolver
+from .StubUpstream import start_stub
+
+
+class NullTransport:
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr=None):
+        self.sent += 1
+
+
+async def main(n: int = 100000, answers: int = 4):
+    stub_transport, stub = await start_stub()
+    stub.addresses = tuple('10.0.0.{}'.format(i) for i in range(1, answers + 1))
+    LocalResolver.upstream = LocalResolver.Upstream(stub_transport.get_extra_info('sockname'))
+
+    protocol = LocalResolver.DNSServerProtocol()
+    transport = NullTransport()
+    protocol.connection_made(transport)
+
+    request = dns.message.make_query('hot.example.', 'A')
+    wire = request.to_wire()
+    addr = ('127.0.0.1', 1)
+
+    # the first query fills the cache through the stub upstream
+    protocol.datagram_received(wire, addr)
+    while transport.sent == 0:
+        await asyncio.sleep(0.01)
+
+    begin = time.perf_counter()
+    for _ in range(n):
+        protocol.datagram_received(wire, addr)
+    elapsed = time.perf_counter() - begin
+
+    assert transport.sent == n + 1
+    print('cache hits with {} answers: {:.0f} queries/sec'.format(answers, n / elapsed))
+    print('hit latency', LocalResolver.hit_latency.summary())
+    stub_transport.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
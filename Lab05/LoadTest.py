@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Dict, List, Tuple
+
+import dns.message
+
+from . import LocalResolver
+from .StubUpstream import start_stub
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(int.from_bytes(data[0:2], byteorder='big'), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def ask(client: ClientProtocol, txid: int, domain: str) -> float:
+    request = dns.message.make_query(domain, 'A')
+    request.id = txid
+    future = asyncio.get_event_loop().create_future()
+    client.pending[txid] = future
+
+    begin = time.perf_counter()
+    client.transport.sendto(request.to_wire())
+    await asyncio.wait_for(future, 10)
+    return time.perf_counter() - begin
+
+
+def describe(name: str, latencies: List[float]):
+    latencies = sorted(latencies)
+    print('{:>6}: {:>5} queries, p50 {:8.2f} ms, p99 {:8.2f} ms, max {:8.2f} ms'.format(
+        name, len(latencies), latencies[len(latencies) // 2] * 1000,
+        latencies[len(latencies) * 99 // 100] * 1000, latencies[-1] * 1000))
+
+
+async def main(upstream_delay: float = 0.2, misses: int = 200, hits: int = 2000, herd: int = 100):
+    loop = asyncio.get_event_loop()
+    stub_transport, stub = await start_stub(delay=upstream_delay)
+    LocalResolver.upstream = LocalResolver.Upstream(stub_transport.get_extra_info('sockname'))
+
+    server_transport, _ = await loop.create_datagram_endpoint(
+        LocalResolver.DNSServerProtocol, local_addr=('127.0.0.1', 0)
+    )
+    server: Tuple[str, int] = server_transport.get_extra_info('sockname')
+    _, client = await loop.create_datagram_endpoint(ClientProtocol, remote_addr=server)
+
+    await ask(client, 0, 'hot.example.')
+
+    # misses are sent first, every hit is answered while they wait for the upstream
+    miss_tasks = [asyncio.ensure_future(ask(client, 1 + i, 'miss{}.example.'.format(i))) for i in range(misses)]
+    await asyncio.sleep(0)
+    hit_latencies = []
+    for i in range(hits):
+        hit_latencies.append(await ask(client, 1 + misses + i, 'hot.example.'))
+    miss_latencies = await asyncio.gather(*miss_tasks)
+
+    # many clients asking for the same uncached name at once
+    stub.queries = 0
+    herd_latencies = await asyncio.gather(*[ask(client, 1 + misses + hits + i, 'herd.example.')
+                                            for i in range(herd)])
+
+    print('upstream delay {:.0f} ms'.format(upstream_delay * 1000))
+    describe('hit', hit_latencies)
+    describe('miss', miss_latencies)
+    describe('herd', herd_latencies)
+    print('herd of {} caused {} upstream queries'.format(herd, stub.queries))
+    print(LocalResolver.coalesce_stats)
+    print(LocalResolver.cache.stats())
+
+    server_transport.close()
+    stub_transport.close()
+
+
+async def hot_name(prefetch_fraction: float, upstream_delay: float = 0.2, ttl: int = 2, seconds: float = 6.0):
+    """Ask for one name with a short TTL for a while, it expires several times."""
+    loop = asyncio.get_event_loop()
+    LocalResolver.cache = LocalResolver.DNSCache()
+    LocalResolver.prefetch_fraction = prefetch_fraction
+
+    stub_transport, stub = await start_stub(delay=upstream_delay, ttl=ttl)
+    LocalResolver.upstream = LocalResolver.Upstream(stub_transport.get_extra_info('sockname'))
+    server_transport, _ = await loop.create_datagram_endpoint(
+        LocalResolver.DNSServerProtocol, local_addr=('127.0.0.1', 0)
+    )
+    _, client = await loop.create_datagram_endpoint(
+        ClientProtocol, remote_addr=server_transport.get_extra_info('sockname')
+    )
+
+    latencies = []
+    begin = time.perf_counter()
+    txid = 0
+    while time.perf_counter() - begin < seconds:
+        txid += 1
+        latencies.append(await ask(client, txid, 'popular.example.'))
+        await asyncio.sleep(0.01)
+
+    describe('prefetch {}'.format(prefetch_fraction), latencies)
+
+    server_transport.close()
+    stub_transport.close()
+
+
+async def serve_stale(upstream_delay: float = 0.2, ttl: int = 1):
+    """Stop the upstream after the first answer, the expired answer is still served."""
+    loop = asyncio.get_event_loop()
+    LocalResolver.cache = LocalResolver.DNSCache(max_stale=60)
+
+    stub_transport, stub = await start_stub(delay=upstream_delay, ttl=ttl)
+    LocalResolver.upstream = LocalResolver.Upstream(stub_transport.get_extra_info('sockname'), timeout=0.5)
+    server_transport, _ = await loop.create_datagram_endpoint(
+        LocalResolver.DNSServerProtocol, local_addr=('127.0.0.1', 0)
+    )
+    _, client = await loop.create_datagram_endpoint(
+        ClientProtocol, remote_addr=server_transport.get_extra_info('sockname')
+    )
+
+    await ask(client, 1, 'stale.example.')
+    stub_transport.close()
+    await asyncio.sleep(ttl + 1)
+    latency = await ask(client, 2, 'stale.example.')
+    print('stale answer after upstream went down: {:.0f} ms'.format(latency * 1000))
+
+    server_transport.close()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
+    loop.run_until_complete(hot_name(0))
+    loop.run_until_complete(hot_name(0.5))
+    loop.run_until_complete(serve_stale())
@@ -1,24 +1,43 @@
-from collections import defaultdict
+from collections import OrderedDict
+import heapq
+import json
+import logging
+import mmap
+import os
+import time
 
-from dns.resolver import query, Answer, NoAnswer
+import dns.rcode
+from dns.resolver import get_default_resolver
+import argparse
 import asyncio
-from typing import Tuple, List, Dict
+import multiprocessing
+from multiprocessing import shared_memory
+import random
+from typing import Awaitable, Tuple, List, Dict, Optional, Union
 import struct
-import ipaddress
+import zlib
 from datetime import datetime
-import copy
 
 from enum import Enum, unique
 
+from common.Histogram import Histogram
+
+log = logging.getLogger('LocalResolver')
+
 
 @unique
 class QType(Enum):
     A = 1
     NS = 2
     CNAME = 5
+    SOA = 6
+    PTR = 12
     MX = 15
     TXT = 16
     AAAA = 28
+    SRV = 33
+    OPT = 41
+    ANY = 255
 
 
 @unique
@@ -27,6 +46,18 @@ class QClass(Enum):
     ANY = 255
 
 
+def type_name(qtype: int) -> str:
+    """Mnemonic of a type, TYPEn for the ones without a member above (RFC 3597 5)."""
+    try:
+        return QType(qtype).name
+    except ValueError:
+        return 'TYPE{}'.format(qtype)
+
+
+class DNSFormatError(Exception):
+    pass
+
+
 class DNSHeader:
     Struct = struct.Struct('!6H')
 
@@ -48,6 +79,8 @@ class DNSHeader:
         self.ARCount = None
 
     def parse_header(self, data):
+        if len(data) < DNSHeader.Struct.size:
+            raise DNSFormatError('message shorter than its header')
         self.data = data
         self.ID, misc, self.QDCount, self.ANCount, self.NSCount, self.ARCount = DNSHeader.Struct.unpack_from(data)
 
@@ -64,199 +97,1134 @@ class DNSHeader:
         return '<DNSHeader {}>'.format(str(self.__dict__))
 
 
+# labels of a domain name, without the empty root label
+Name = Tuple[bytes, ...]
+
+
 class DNSQuestion:
-    def __init__(self, domain, qtype, qclass):
+    """
+    A question keyed on the plain type and class numbers, so that types
+    without a QType member (HTTPS, SVCB, CAA, DS, ...) are forwarded and
+    cached like any other.
+    """
+
+    def __init__(self, domain: str, qtype: int, qclass: int):
         self.domain = domain
         self.qtype = qtype
         self.qclass = qclass
+        # questions are cache keys, hashing the tuple every time is not free
+        self.hash = hash((domain, qtype, qclass))
 
     def __str__(self):
         return '<DNSQuestion {}>'.format(str(self.__dict__))
 
     def __hash__(self):
-        return hash((self.domain, self.qtype, self.qclass))
+        return self.hash
 
     def __eq__(self, other):
         return (self.domain, self.qtype, self.qclass) == (other.domain, other.qtype, other.qclass)
 
+    def name(self) -> Name:
+        return tuple(self.domain.encode('latin-1').split(b'.')) if self.domain else ()
+
 
 class ResourceRecord:
-    def __init__(self, name_bytes: bytes, qtype: QType, qclass: QClass, ttl: int, data: bytes):
-        self.name_bytes = name_bytes
-        self.qtype = qtype
-        self.qclass = qclass
+    """
+    A resource record, `rdata` is a list of byte strings and names. Names
+    are only split out for the types whose rdata may be compressed.
+    """
+
+    def __init__(self, name: Name, rtype: int, rclass: int, ttl: int, rdata: List[Union[bytes, Name]]):
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
         self.ttl = ttl
-        self.data = data
+        self.rdata = rdata
 
 
-def parse_query(data: bytes) -> Tuple[DNSHeader, List[DNSQuestion], bytes]:
-    header = DNSHeader()
-    header.parse_header(data[0:12])
+# type and class of a question, they follow its name
+QuestionStruct = struct.Struct('!HH')
+# type, class, ttl and rdlength of a resource record, they follow its owner name
+RecordStruct = struct.Struct('!HHIH')
+TTLStruct = struct.Struct('!I')
+PointerStruct = struct.Struct('!H')
+
+# the UDP payload size advertised through EDNS0 (DNS flag day 2020)
+udp_payload_size = 1232
+
+
+def parse_name(data: bytes, offset: int) -> Tuple[Name, int]:
+    """Read a possibly compressed name, return it and the offset right after it."""
+    labels = []
+    end = -1
+    length = 1
+    while True:
+        if offset >= len(data):
+            raise DNSFormatError('name runs past the end of the message')
+        size = data[offset]
+        if size >= 0xC0:
+            if offset + 1 >= len(data):
+                raise DNSFormatError('name runs past the end of the message')
+            pointer = ((size & 0x3F) << 8) | data[offset + 1]
+            # pointers may only go backwards, which also rules out loops
+            if pointer >= offset:
+                raise DNSFormatError('forward compression pointer')
+            if end < 0:
+                end = offset + 2
+            offset = pointer
+        elif size >= 0x40:
+            raise DNSFormatError('unknown label type')
+        elif size == 0:
+            offset += 1
+            break
+        else:
+            length += size + 1
+            if length > 255 or offset + 1 + size > len(data):
+                raise DNSFormatError('bad name')
+            labels.append(bytes(data[offset + 1:offset + 1 + size]))
+            offset += 1 + size
+    return tuple(labels), end if end >= 0 else offset
+
 
-    body = data[12:]
-    offset, questions = parse_questions(header.QDCount, body)
+def encode_name(name: Name) -> bytes:
+    return b''.join(bytes((len(label),)) + label for label in name) + b'\x00'
 
-    if len(data) != 12 + offset:
-        print("data length:", len(data), "  handled length", 12 + offset)
 
-    return header, questions, body[:offset]
+class NameTable:
+    """Offsets of the names already written to a message, for compression (RFC 1035 4.1.4)."""
+
+    def __init__(self):
+        self.offsets: Dict[Name, int] = {}
+
+    def write(self, out: bytearray, name: Name):
+        lower = [label.lower() for label in name]
+        for i in range(len(name)):
+            suffix = tuple(lower[i:])
+            pointer = self.offsets.get(suffix)
+            if pointer is not None:
+                out += PointerStruct.pack(0xC000 | pointer)
+                return
+            if len(out) < 0x4000:
+                self.offsets[suffix] = len(out)
+            out.append(len(name[i]))
+            out += name[i]
+        out.append(0)
+
+
+def parse_question(data: bytes, offset: int) -> Tuple[DNSQuestion, Name, int]:
+    name, offset = parse_name(data, offset)
+    if offset + QuestionStruct.size > len(data):
+        raise DNSFormatError('question runs past the end of the message')
+    qtype, qclass = QuestionStruct.unpack_from(data, offset)
+    domain = b'.'.join(name).lower().decode('latin-1')
+    return DNSQuestion(domain, qtype, qclass), name, offset + QuestionStruct.size
+
+
+def parse_rdata(data: bytes, offset: int, end: int, rtype: int) -> List[Union[bytes, Name]]:
+    if rtype in (QType.NS.value, QType.CNAME.value, QType.PTR.value):
+        name, offset = parse_name(data, offset)
+        rdata = [name]
+    elif rtype == QType.MX.value:
+        preference = bytes(data[offset:offset + 2])
+        name, offset = parse_name(data, offset + 2)
+        rdata = [preference, name]
+    elif rtype == QType.SOA.value:
+        mname, offset = parse_name(data, offset)
+        rname, offset = parse_name(data, offset)
+        rdata = [mname, rname, bytes(data[offset:offset + 20])]
+        offset += 20
+    else:
+        rdata = [bytes(data[offset:end])]
+        offset = end
+    if offset != end:
+        raise DNSFormatError('rdata length mismatch')
+    return rdata
 
 
-def parse_questions(size: int, body: bytes) -> Tuple[int, List[DNSQuestion]]:
-    offset = 0
+def parse_record(data: bytes, offset: int) -> Tuple[ResourceRecord, int]:
+    name, offset = parse_name(data, offset)
+    if offset + RecordStruct.size > len(data):
+        raise DNSFormatError('record runs past the end of the message')
+    rtype, rclass, ttl, rdlength = RecordStruct.unpack_from(data, offset)
+    offset += RecordStruct.size
+    end = offset + rdlength
+    if end > len(data):
+        raise DNSFormatError('rdata runs past the end of the message')
+    # TTLs with the top bit set are treated as zero (RFC 2181 8)
+    ttl = 0 if ttl & 0x80000000 else ttl
+    return ResourceRecord(name, rtype, rclass, ttl, parse_rdata(data, offset, end, rtype)), end
+
+
+Sections = Tuple[List[ResourceRecord], List[ResourceRecord], List[ResourceRecord]]
+
+
+def parse_questions(data: bytes, count: int) -> Tuple[List[DNSQuestion], List[Name], int]:
+    offset = DNSHeader.Struct.size
     questions = []
-    for _ in range(size):
-        offset, question = parse_question(offset, body)
+    names = []
+    for _ in range(count):
+        question, name, offset = parse_question(data, offset)
         questions.append(question)
-    return offset, questions
+        names.append(name)
+    return questions, names, offset
 
 
-def parse_question(offset: int, body: bytes) -> Tuple[int, DNSQuestion]:
-    domain = ""
-    length = body[offset]
-    while True:
-        offset += 1
-        domain += body[offset: offset + length].decode()
-        offset += length
-        length = body[offset]
-        if length != 0:
-            domain += '.'
+def parse_records(data: bytes, offset: int, count: int) -> Tuple[List[ResourceRecord], int]:
+    records = []
+    for _ in range(count):
+        record, offset = parse_record(data, offset)
+        records.append(record)
+    return records, offset
+
+
+def parse_message(data: bytes) -> Tuple[DNSHeader, List[DNSQuestion], Sections]:
+    header = DNSHeader()
+    header.parse_header(data[0:12])
+
+    questions, _, offset = parse_questions(data, header.QDCount)
+    answer, offset = parse_records(data, offset, header.ANCount)
+    authority, offset = parse_records(data, offset, header.NSCount)
+    additional, offset = parse_records(data, offset, header.ARCount)
+
+    return header, questions, (answer, authority, additional)
+
+
+def parse_query(data: bytes) -> Tuple[DNSHeader, List[DNSQuestion], bytes, Optional[int]]:
+    """
+    Parse a query, also return its question section without compression and
+    the UDP payload size of its EDNS0 OPT record, if any.
+    """
+    header = DNSHeader()
+    header.parse_header(data[0:12])
+
+    questions, names, offset = parse_questions(data, header.QDCount)
+    # a compressed name is always shorter, otherwise the section is copied as it is
+    plain = sum(sum(len(label) + 1 for label in name) + 1 + QuestionStruct.size for name in names)
+    if offset - DNSHeader.Struct.size == plain:
+        questions_bytes = bytes(data[DNSHeader.Struct.size:offset])
+    else:
+        questions_bytes = b''.join(encode_name(name) + QuestionStruct.pack(question.qtype, question.qclass)
+                                   for question, name in zip(questions, names))
+
+    edns = None
+    if header.ANCount or header.NSCount or header.ARCount:
+        _, offset = parse_records(data, offset, header.ANCount + header.NSCount)
+        additional, _ = parse_records(data, offset, header.ARCount)
+        for record in additional:
+            if record.rtype == QType.OPT.value:
+                edns = record.rclass
+
+    return header, questions, questions_bytes, edns
+
+
+def opt_record(payload_size: int) -> bytes:
+    return b'\x00' + RecordStruct.pack(QType.OPT.value, payload_size, 0, 0)
+
+
+def make_query(txid: int, question: DNSQuestion) -> bytes:
+    data = DNSHeader.Struct.pack(txid, 0x0100, 1, 0, 0, 1)
+    data += encode_name(question.name())
+    data += QuestionStruct.pack(question.qtype, question.qclass)
+    data += opt_record(udp_payload_size)
+    return data
+
+
+def encode_records(question: DNSQuestion, sections: Sections) -> Tuple[bytes, List[Tuple[int, int]], int]:
+    """
+    Encode the records of a response to `question` in wire format, with names
+    compressed as if the question was the first one of the message. Also return
+    the (offset, ttl) of every TTL field and where the additional section starts.
+    """
+    out = bytearray(DNSHeader.Struct.size)
+    table = NameTable()
+    table.write(out, question.name())
+    out += QuestionStruct.pack(question.qtype, question.qclass)
+    base = len(out)
+
+    ttls = []
+    additional = 0
+    for index, records in enumerate(sections):
+        if index == 2:
+            additional = len(out) - base
+        for record in records:
+            table.write(out, record.name)
+            start = len(out)
+            out += RecordStruct.pack(record.rtype, record.rclass, record.ttl, 0)
+            for part in record.rdata:
+                if isinstance(part, tuple):
+                    table.write(out, part)
+                else:
+                    out += part
+            PointerStruct.pack_into(out, start + 8, len(out) - start - RecordStruct.size)
+            ttls.append((start + 4 - base, record.ttl))
+
+    return bytes(out[base:]), ttls, additional
+
+
+class CacheEntry:
+    """
+    Records of the answer to one question kept in wire format. Only the TTL
+    fields change between responses, they are patched in place when written.
+    """
+
+    def __init__(self, wire: bytes, ttls: List[Tuple[int, int]], counts: Tuple[int, int, int], additional: int,
+                 stored: int, expires: int, rcode: int, size: int):
+        self.wire = wire
+        self.ttls = ttls
+        self.counts = counts
+        # offset of the additional section in wire, it is left out first when the response is too big
+        self.additional = additional
+        self.stored = stored
+        self.expires = expires
+        self.rcode = rcode
+        self.size = size
+        self.hits = 0
+
+    def stale(self, now: int, ttl: int) -> 'CacheEntry':
+        """The same answer handed out after expiry, with every TTL set to `ttl`."""
+        return CacheEntry(self.wire, [(offset, ttl) for offset, _ in self.ttls], self.counts, self.additional,
+                          now, now, self.rcode, self.size)
+
+    # stored, expires, rcode, the three section counts, additional offset and number of TTLs
+    Struct = struct.Struct('!IIBHHHHH')
+    TTLItemStruct = struct.Struct('!HI')
+
+    def to_bytes(self) -> bytes:
+        data = [CacheEntry.Struct.pack(self.stored, self.expires, self.rcode, *self.counts, self.additional,
+                                       len(self.ttls))]
+        data.extend(CacheEntry.TTLItemStruct.pack(offset, ttl) for offset, ttl in self.ttls)
+        data.append(self.wire)
+        return b''.join(data)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'CacheEntry':
+        if len(data) < CacheEntry.Struct.size:
+            raise DNSFormatError('cache entry too short')
+        stored, expires, rcode, an, ns, ar, additional, count = CacheEntry.Struct.unpack_from(data)
+        offset = CacheEntry.Struct.size
+        if len(data) < offset + count * CacheEntry.TTLItemStruct.size:
+            raise DNSFormatError('cache entry too short')
+        ttls = [CacheEntry.TTLItemStruct.unpack_from(data, offset + i * CacheEntry.TTLItemStruct.size)
+                for i in range(count)]
+        offset += count * CacheEntry.TTLItemStruct.size
+        return CacheEntry(bytes(data[offset:]), ttls, (an, ns, ar), additional, stored, expires, rcode, 0)
+
+
+def question_to_bytes(question: DNSQuestion) -> bytes:
+    return QuestionStruct.pack(question.qtype, question.qclass) + question.domain.encode('latin-1')
+
+
+def question_from_bytes(data: bytes) -> DNSQuestion:
+    qtype, qclass = QuestionStruct.unpack_from(data)
+    return DNSQuestion(bytes(data[QuestionStruct.size:]).decode('latin-1'), qtype, qclass)
+
+
+class DNSCache:
+    """
+    Bounded cache of answers keyed by question.
+
+    The least recently used entry is evicted once the entry or byte budget is
+    exceeded, and expired entries are removed proactively through a min-heap
+    of expiry times, so memory stays bounded even when every query asks for a
+    new name. Empty answers (NXDOMAIN and NODATA) are cached too, for the
+    negative TTL taken from the SOA record (RFC 2308).
+
+    With `max_stale` set, expired entries are kept that many more seconds so
+    they can be served when the upstream cannot be reached (RFC 8767).
+    """
+
+    # rough per-object overhead, used to keep the byte budget honest for small records
+    entry_overhead = 200
+    record_overhead = 100
+
+    def __init__(self, max_entries: int = 100000, max_bytes: int = 32 * 1024 * 1024,
+                 default_negative_ttl: int = 60, max_negative_ttl: int = 3600, max_stale: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_stale = max_stale
+        self.default_negative_ttl = default_negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+
+        self.entries: OrderedDict[DNSQuestion, CacheEntry] = OrderedDict()
+        self.heap: List[Tuple[int, int, DNSQuestion, CacheEntry]] = []
+        self.counter = 0
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, question: DNSQuestion, now: int) -> Optional[CacheEntry]:
+        entry = self.entries.get(question)
+        if entry is None or entry.expires <= now:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(question)
+        self.hits += 1
+        entry.hits += 1
+        return entry
+
+    def peek(self, question: DNSQuestion, now: int) -> Optional[CacheEntry]:
+        """Like get, without counting the lookup or refreshing the entry."""
+        entry = self.entries.get(question)
+        if entry is None or entry.expires <= now:
+            return None
+        return entry
+
+    def get_stale(self, question: DNSQuestion, now: int) -> Optional[CacheEntry]:
+        entry = self.entries.get(question)
+        if entry is None or entry.expires > now or entry.expires + self.max_stale <= now:
+            return None
+        return entry
+
+    def put(self, question: DNSQuestion, sections: Sections, now: int,
+            rcode: int = 0, negative_ttl: Optional[int] = None) -> CacheEntry:
+        if sections[0]:
+            expires = now + min(record.ttl for records in sections for record in records)
         else:
-            break
-    offset += 1
-    qtype = int.from_bytes(body[offset:offset + 2], byteorder='big')
-    offset += 2
-    qclass = int.from_bytes(body[offset:offset + 2], byteorder='big')
-    offset += 2
+            ttl = self.default_negative_ttl if negative_ttl is None else negative_ttl
+            expires = now + min(ttl, self.max_negative_ttl)
+
+        wire, ttls, additional = encode_records(question, sections)
+        counts = (len(sections[0]), len(sections[1]), len(sections[2]))
+        return self.put_entry(question, CacheEntry(wire, ttls, counts, additional, now, expires, rcode, 0), now)
+
+    def put_entry(self, question: DNSQuestion, entry: CacheEntry, now: int) -> CacheEntry:
+        self.expire(now)
+        entry.size = self.entry_overhead + len(question.domain) + len(entry.wire) + \
+            self.record_overhead * len(entry.ttls)
+
+        if question in self.entries:
+            self.remove(question)
+        self.entries[question] = entry
+        self.bytes += entry.size
+        self.counter += 1
+        heapq.heappush(self.heap, (entry.expires + self.max_stale, self.counter, question, entry))
+
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
 
-    res = DNSQuestion(domain, QType(qtype), QClass(qclass))
-    print(res)
+        # replaced and evicted entries leave their heap items behind, drop them once they dominate
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.heap = [it for it in self.heap if self.entries.get(it[2]) is it[3]]
+            heapq.heapify(self.heap)
 
-    return offset, res
+        return entry
 
+    def remove(self, question: DNSQuestion):
+        entry = self.entries.pop(question)
+        self.bytes -= entry.size
+
+    def expire(self, now: int):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, _, question, entry = heapq.heappop(heap)
+            if self.entries.get(question) is entry:
+                self.remove(question)
+                self.expirations += 1
+
+    # file signature and version, followed by question key length, entry length, key and entry per entry
+    SnapshotMagic = b'DNSC\x01'
+    SnapshotItemStruct = struct.Struct('!HI')
+
+    def snapshot(self, now: int, items: Optional[List[Tuple[DNSQuestion, CacheEntry]]] = None) -> bytes:
+        """
+        Every entry still worth keeping, least recently used first so that
+        loading keeps the order. `items` is a copy of the entries to encode
+        instead, for building a snapshot off the event loop.
+        """
+        data = [self.SnapshotMagic]
+        for question, entry in self.entries.items() if items is None else items:
+            if entry.expires + self.max_stale <= now:
+                continue
+            key = question_to_bytes(question)
+            value = entry.to_bytes()
+            data.append(self.SnapshotItemStruct.pack(len(key), len(value)))
+            data.append(key)
+            data.append(value)
+        return b''.join(data)
+
+    def load(self, path: str, now: int) -> int:
+        """
+        Restore the entries of a snapshot that have not expired yet. Entries keep
+        the time they were stored, so their TTLs count down from there. A
+        missing or damaged file loads what could be read of it.
+        """
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < len(self.SnapshotMagic):
+                    return 0
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return 0
+
+        loaded = 0
+        with data:
+            if data[:len(self.SnapshotMagic)] != self.SnapshotMagic:
+                return 0
+            offset = len(self.SnapshotMagic)
+            while offset + self.SnapshotItemStruct.size <= len(data):
+                key_length, length = self.SnapshotItemStruct.unpack_from(data, offset)
+                offset += self.SnapshotItemStruct.size
+                if offset + key_length + length > len(data):
+                    break
+                try:
+                    question = question_from_bytes(data[offset:offset + key_length])
+                    entry = CacheEntry.from_bytes(data[offset + key_length:offset + key_length + length])
+                except (DNSFormatError, struct.error):
+                    break
+                offset += key_length + length
+
+                if entry.expires + self.max_stale > now:
+                    self.put_entry(question, entry, now)
+                    loaded += 1
+        return loaded
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedCache:
+    """
+    Answers shared by the worker processes, in a fixed table of slots in
+    shared memory. A question always maps to the same slot and a newer answer
+    simply overwrites whatever was there, so there is no locking: every slot
+    carries a CRC of its content, and a slot torn by a concurrent write is
+    just a miss. Answers too big for a slot are not shared.
+    """
+
+    # CRC of the rest of the slot, question key length, entry length
+    SlotStruct = struct.Struct('!IHH')
+
+    def __init__(self, slots: int = 16384, slot_size: int = 1024, name: Optional[str] = None):
+        self.slots = slots
+        self.slot_size = slot_size
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.buffer = self.memory.buf
 
-cache: Dict[DNSQuestion, List[Tuple[int, ResourceRecord]]] = defaultdict(list)
+    def get(self, question: DNSQuestion, now: int) -> Optional[CacheEntry]:
+        key = question_to_bytes(question)
+        offset = zlib.crc32(key) % self.slots * self.slot_size
+        crc, key_length, length = self.SlotStruct.unpack_from(self.buffer, offset)
+        begin = offset + self.SlotStruct.size
+        if key_length != len(key) or key_length + length > self.slot_size - self.SlotStruct.size:
+            return None
 
+        data = bytes(self.buffer[begin:begin + key_length + length])
+        if data[:key_length] != key or zlib.crc32(data) != crc:
+            return None
+        try:
+            entry = CacheEntry.from_bytes(data[key_length:])
+        except DNSFormatError:
+            return None
+        return entry if entry.expires > now else None
 
-def handle(question: DNSQuestion) -> List[ResourceRecord]:
+    def put(self, question: DNSQuestion, entry: CacheEntry):
+        key = question_to_bytes(question)
+        data = key + entry.to_bytes()
+        if len(data) > self.slot_size - self.SlotStruct.size:
+            return
+        offset = zlib.crc32(key) % self.slots * self.slot_size
+        begin = offset + self.SlotStruct.size
+        self.buffer[begin:begin + len(data)] = data
+        self.SlotStruct.pack_into(self.buffer, offset, zlib.crc32(data), len(key), len(data) - len(key))
+
+    def close(self, unlink: bool = False):
+        self.buffer.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+cache = DNSCache()
+# set when several worker processes share their answers
+shared: Optional[SharedCache] = None
+
+
+def cached(question: DNSQuestion, now: int) -> Optional[CacheEntry]:
+    entry = cache.get(question, now)
+    if entry is None and shared is not None:
+        entry = shared.get(question, now)
+        if entry is not None:
+            query_stats['shared_hits'] += 1
+            cache.put_entry(question, entry, now)
+    return entry
+
+
+def stats() -> Dict[str, Dict]:
+    return {
+        'pid': os.getpid(),
+        'queries': query_stats,
+        'coalesce': coalesce_stats,
+        'cache': cache.stats(),
+        'latency': {
+            'hit': hit_latency.summary(),
+            'miss': miss_latency.summary(),
+            'upstream': upstream_latency.summary(),
+        },
+    }
+
+
+async def sweep(interval: float = 1.0):
+    while True:
+        cache.expire(int(datetime.now().timestamp()))
+        await asyncio.sleep(interval)
+
+
+def write_snapshot(path: str, now: int, items: Optional[List[Tuple[DNSQuestion, CacheEntry]]] = None):
+    data = cache.snapshot(now, items)
+    # written next to the old one and renamed over it, a crash never leaves half a snapshot
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+async def save(path: str, interval: float = 60.0):
+    """Snapshot the cache to `path` every `interval` seconds, it is encoded and written off the event loop."""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        # the loop keeps changing the cache, the executor encodes a copy of its items
+        items = list(cache.entries.items())
+        try:
+            await loop.run_in_executor(None, write_snapshot, path, int(datetime.now().timestamp()), items)
+        except OSError as e:
+            log.error('Snapshot to %s failed: %s', path, e)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.pending: Dict[int, asyncio.Future] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        future = self.pending.get(int.from_bytes(data[0:2], byteorder='big'))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(UpstreamError('upstream socket closed'))
+        self.pending.clear()
+
+
+class Upstream:
+    """
+    Asyncio UDP client of the upstream server, many queries share one
+    socket and responses are matched to them by transaction ID.
+    """
+
+    def __init__(self, address: Tuple[str, int], timeout: float = 2.0, retries: int = 2):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.protocol: Optional[UpstreamProtocol] = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self) -> UpstreamProtocol:
+        async with self.lock:
+            if self.protocol is None or self.protocol.transport.is_closing():
+                loop = asyncio.get_event_loop()
+                _, self.protocol = await loop.create_datagram_endpoint(
+                    UpstreamProtocol, remote_addr=self.address
+                )
+        return self.protocol
+
+    async def query(self, question: DNSQuestion) -> Tuple[DNSHeader, Sections]:
+        try:
+            protocol = await self.connect()
+        except OSError as e:
+            # e.g. no route or out of file descriptors, the lookup fails like any other
+            raise UpstreamError('cannot reach {}: {!r}'.format(self.address, e))
+
+        txid = random.randrange(0x10000)
+        while txid in protocol.pending:
+            txid = random.randrange(0x10000)
+        wire = make_query(txid, question)
+
+        loop = asyncio.get_event_loop()
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    query_stats['upstream_retries'] += 1
+                future = loop.create_future()
+                protocol.pending[txid] = future
+                protocol.transport.sendto(wire)
+                try:
+                    data = await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+
+                response = self.parse(data, question)
+                if response is None:
+                    continue
+                if response[0].TC:
+                    response = self.parse(await self.query_tcp(wire), question)
+                    if response is None:
+                        raise UpstreamError('bad TCP response for {}'.format(question.domain))
+                return response
+        finally:
+            protocol.pending.pop(txid, None)
+
+        raise UpstreamError('no response from {} for {}'.format(self.address, question.domain))
+
+    async def query_tcp(self, wire: bytes) -> bytes:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.timeout)
+            try:
+                writer.write(len(wire).to_bytes(2, byteorder='big') + wire)
+                length = int.from_bytes(await asyncio.wait_for(reader.readexactly(2), self.timeout), byteorder='big')
+                return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+            finally:
+                writer.close()
+        except (OSError, EOFError, asyncio.TimeoutError) as e:
+            raise UpstreamError('TCP query to {} failed: {!r}'.format(self.address, e))
+
+    @staticmethod
+    def parse(data: bytes, question: DNSQuestion) -> Optional[Tuple[DNSHeader, Sections]]:
+        try:
+            header, questions, sections = parse_message(data)
+        except DNSFormatError:
+            return None
+        if not header.QR or questions != [question]:
+            return None
+        return header, sections
+
+
+# set up by the server, or by whoever drives this module against an upstream of its own
+upstream: Optional[Upstream] = None
+
+
+# upstream lookups in flight, identical questions wait for the same one
+inflight: Dict[DNSQuestion, asyncio.Future] = {}
+coalesce_stats: Dict[str, int] = {'lookups': 0, 'coalesced': 0, 'prefetches': 0, 'stale': 0}
+
+# queries by outcome, hits and misses are those of the local and shared cache together
+query_stats: Dict[str, int] = {'queries': 0, 'tcp': 0, 'hits': 0, 'shared_hits': 0, 'misses': 0, 'errors': 0,
+                               'servfail': 0, 'upstream_errors': 0, 'upstream_retries': 0}
+hit_latency = Histogram()
+miss_latency = Histogram()
+upstream_latency = Histogram()
+
+# an entry hit at least `prefetch_hits` times is refreshed in the background
+# once at most `prefetch_fraction` of its TTL or one second is left, 0 turns it off
+prefetch_fraction = 0.1
+prefetch_hits = 2
+
+# how long a client waits for the upstream before an expired answer is served instead
+stale_timeout = 1.0
+stale_ttl = 30
+
+
+def refresh(question: DNSQuestion) -> asyncio.Future:
+    task = inflight.get(question)
+    if task is None:
+        coalesce_stats['lookups'] += 1
+        task = asyncio.ensure_future(update(question))
+        inflight[question] = task
+
+        def done(_):
+            inflight.pop(question, None)
+            # a prefetch has nobody waiting on it and waiters may all give up,
+            # so a failure is retrieved here, waiters answer SERVFAIL on their own
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+    return task
+
+
+def prefetch(question: DNSQuestion, entry: CacheEntry, now: int):
+    # the clock counts whole seconds, below 10 s the fraction of a TTL at 0.1 is never reached
+    if prefetch_fraction and entry.hits >= prefetch_hits and question not in inflight and \
+            entry.expires - now <= max(1, (entry.expires - entry.stored) * prefetch_fraction):
+        coalesce_stats['prefetches'] += 1
+        refresh(question)
+
+
+async def handle(question: DNSQuestion) -> CacheEntry:
+    """Resolve a question that missed the cache."""
     now = int(datetime.now().timestamp())
+    # it may have been answered since the miss, that lookup was already counted
+    entry = cache.peek(question, now)
+    if entry is not None:
+        return entry
+
+    if question in inflight:
+        coalesce_stats['coalesced'] += 1
+    task = refresh(question)
+
+    stale = cache.get_stale(question, now)
+    if stale is None:
+        # shielded, so one waiter giving up does not cancel the lookup for the others
+        return await asyncio.shield(task)
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), stale_timeout)
+    except (asyncio.TimeoutError, UpstreamError):
+        coalesce_stats['stale'] += 1
+        return stale.stale(int(datetime.now().timestamp()), stale_ttl)
+
+
+async def update(question: DNSQuestion) -> CacheEntry:
+    log.debug('Updating %s %s', question.domain, type_name(question.qtype))
+    sections, rcode, negative_ttl = await send_query(question)
+    entry = cache.put(question, sections, int(datetime.now().timestamp()), rcode, negative_ttl)
+    if shared is not None:
+        shared.put(question, entry)
+    return entry
+
+
+async def send_query(question: DNSQuestion) -> Tuple[Sections, int, Optional[int]]:
+    begin = time.perf_counter()
+    header, (answer, authority, additional) = await upstream.query(question)
+    upstream_latency.record(time.perf_counter() - begin)
+    rcode = header.RCode
+    if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        raise UpstreamError('upstream answered {}'.format(dns.rcode.to_text(rcode)))
 
-    should_send_query = len(cache[question]) == 0
-    should_send_query = should_send_query or any(now - time >= record.ttl for time, record in cache[question])
+    # the OPT record belongs to the upstream hop, a new one is added for each client
+    additional = [it for it in additional if it.rtype != QType.OPT.value]
+    sections = (answer, authority, additional)
 
-    if should_send_query:
-        print("There are {} records in cache. Now should update cache".format(len(cache[question])))
-        cache[question].extend([(now, record) for record in send_query(question)])
+    negative_ttl = None
+    if rcode == dns.rcode.NXDOMAIN or not answer:
+        log.debug('No answer for %s %s', question.domain, type_name(question.qtype))
+        # negative TTL is the smaller of the SOA TTL and its MINIMUM field (RFC 2308)
+        for it in authority:
+            if it.rtype == QType.SOA.value:
+                negative_ttl = min(it.ttl, TTLStruct.unpack_from(it.rdata[2], 16)[0])
 
-    cache[question] = list(filter(lambda item: now - item[0] < item[1].ttl, cache[question]))
+    return sections, rcode, negative_ttl
 
-    result = []
-    for time, record in cache[question]:
-        record_copy = copy.deepcopy(record)
-        record_copy.ttl -= now - time
-        result.append(record_copy)
 
-    return result
+def write(header: DNSHeader, questions_bytes: bytes, entry: Optional[CacheEntry], now: int,
+          rcode: int = 0, edns: Optional[int] = None, limit: int = 512) -> bytes:
+    """
+    Build the response to a query. The additional section is left out when the
+    response would be bigger than `limit`, and if it still does not fit, all
+    records are and the TC bit is set so that the client retries over TCP.
+    """
+    misc = (int.from_bytes(header.data[2:4], byteorder='big') | 0x8080) & 0xFDF0 | rcode
+    counts = (0, 0, 0)
+    wire_length = 0
+    opt = opt_record(udp_payload_size) if edns is not None else b''
 
+    fixed = DNSHeader.Struct.size + len(questions_bytes) + len(opt)
+    if entry is not None:
+        counts = entry.counts
+        wire_length = len(entry.wire)
+        if fixed + wire_length > limit:
+            counts = (counts[0], counts[1], 0)
+            wire_length = entry.additional
+        if fixed + wire_length > limit:
+            counts = (0, 0, 0)
+            wire_length = 0
+            misc |= 0x0200
 
-def send_query(question: DNSQuestion) -> List[ResourceRecord]:
-    print("Updating records")
-    answer: Answer
+    data = bytearray(fixed + wire_length)
+    DNSHeader.Struct.pack_into(data, 0, header.ID, misc, 1 if questions_bytes else 0,
+                               counts[0], counts[1], counts[2] + (1 if opt else 0))
+    offset = DNSHeader.Struct.size
+    data[offset:offset + len(questions_bytes)] = questions_bytes
+    offset += len(questions_bytes)
+
+    if wire_length:
+        data[offset:offset + wire_length] = memoryview(entry.wire)[:wire_length]
+        elapsed = now - entry.stored
+        for ttl_offset, ttl in entry.ttls:
+            if ttl_offset >= wire_length:
+                break
+            TTLStruct.pack_into(data, offset + ttl_offset, max(0, ttl - elapsed))
+        offset += wire_length
+
+    data[offset:] = opt
+    return bytes(data)
+
+
+def udp_limit(edns: Optional[int]) -> int:
+    if edns is None:
+        return 512
+    return max(512, min(edns, udp_payload_size))
+
+
+# largest message that fits the two byte length prefix of DNS over TCP
+tcp_limit = 65535
+# TCP connections without a query for this long are closed
+tcp_idle_timeout = 10.0
+
+
+def answer(data: bytes, now: int, limit: Optional[int] = None) -> Tuple[Optional[bytes], Optional[Awaitable[bytes]]]:
+    """
+    Answer one query message. Cache hits and malformed queries are answered
+    right away, for misses a coroutine is returned that resolves the question
+    and gives the response. `limit` is the largest response the transport
+    can carry, None for the one the client advertised over UDP.
+    """
+    begin = time.perf_counter()
+    # responses are never answered
+    if len(data) < DNSHeader.Struct.size or data[2] & 0x80:
+        return None, None
+    query_stats['queries'] += 1
     try:
-        answer = query(question.domain, question.qtype.value, question.qclass.value)
-    except NoAnswer:
-        print("NoAnswer")
-        return []
-
-    result = []
-    for it in answer.response.answer:
-
-        def label_to_bytes(labels: Tuple[bytes]) -> bytes:
-            label_data = b''
-            for label in labels:
-                label_data += int.to_bytes(len(label), 1, byteorder='big')
-                label_data += label
-            return label_data
-
-        name_bytes = label_to_bytes(it.name)
-        ttl = it.ttl
-        qtype = QType(it.rdtype)
-        qclass = QClass(it.rdclass)
-
-        for item in it.items:
-            data: bytes = b''
-
-            if qtype == QType.A:
-                data = ipaddress.ip_address(item.address).packed
-            elif qtype == QType.NS:
-                data = label_to_bytes(item.target.labels)
-            elif qtype == QType.CNAME:
-                data = label_to_bytes(item.target.labels)
-            elif qtype == QType.MX:
-                data = int.to_bytes(item.preference, 2, byteorder='big')
-                data += label_to_bytes(item.exchange.labels)
-            elif qtype == QType.TXT:
-                data = b''
-                for string in item.strings:
-                    data += int.to_bytes(len(string), 1, byteorder='big')
-                    data += string
-                pass
-            elif qtype == QType.AAAA:
-                data = ipaddress.ip_address(item.address).packed
-
-            rdata = ResourceRecord(name_bytes, qtype, qclass, ttl, data)
-            result.append(rdata)
-
-    return result
-
-
-def write(header: DNSHeader, questions_bytes: bytes, questions: List[DNSQuestion],
-          responds: List[ResourceRecord]) -> bytes:
-    data = b''
-    data += header.data[0:2]
-    data += int.to_bytes(header.data[2] | 0x80, 1, byteorder='big')
-    data += int.to_bytes(header.data[3], 1, byteorder='big')
-    data += header.data[4:6]
-    data += int.to_bytes(len(responds), 2, byteorder='big')
-    data += int.to_bytes(0, 2, byteorder='big')
-    data += int.to_bytes(0, 2, byteorder='big')
-    data += questions_bytes
-
-    for record in responds:
-        data += record.name_bytes
-        data += int.to_bytes(record.qtype.value, 2, byteorder='big')
-        data += int.to_bytes(record.qclass.value, 2, byteorder='big')
-        data += int.to_bytes(record.ttl, 4, byteorder='big')
-        data += int.to_bytes(len(record.data), 2, byteorder='big')
-        data += record.data
+        header, questions, questions_bytes, edns = parse_query(data)
+    except DNSFormatError:
+        header = DNSHeader()
+        header.parse_header(data[0:12])
+        query_stats['errors'] += 1
+        return write(header, b'', None, now, dns.rcode.FORMERR), None
 
-    return data
+    # only one question per query is supported (RFC 9619)
+    if len(questions) != 1:
+        query_stats['errors'] += 1
+        return write(header, b'', None, now, dns.rcode.FORMERR, edns), None
+    question = questions[0]
+    if limit is None:
+        limit = udp_limit(edns)
 
+    # answer from cache right away, only misses wait for the upstream
+    entry = cached(question, now)
+    if entry is None:
+        query_stats['misses'] += 1
+        return None, resolve(header, question, questions_bytes, edns, limit, begin)
+    query_stats['hits'] += 1
+    prefetch(question, entry, now)
+    response = write(header, questions_bytes, entry, now, entry.rcode, edns, limit)
+    hit_latency.record(time.perf_counter() - begin)
+    return response, None
+
+
+async def resolve(header: DNSHeader, question: DNSQuestion, questions_bytes: bytes,
+                  edns: Optional[int], limit: int, begin: float) -> bytes:
+    entry = None
+    rcode = dns.rcode.SERVFAIL
+    try:
+        entry = await handle(question)
+        rcode = entry.rcode
+    except UpstreamError as e:
+        query_stats['upstream_errors'] += 1
+        query_stats['servfail'] += 1
+        log.warning('Upstream failed for %s: %s', question.domain, e)
 
-class DNSServerProtocol(asyncio.Protocol):
+    response = write(header, questions_bytes, entry, int(datetime.now().timestamp()), rcode, edns, limit)
+    miss_latency.record(time.perf_counter() - begin)
+    return response
+
+
+class DNSServerProtocol(asyncio.DatagramProtocol):
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        header, questions, questions_bytes = parse_query(data)
-        responds = []
-        for question in questions:
-            responds += handle(question)
-        to_write = write(header, questions_bytes, questions, responds)
-        self.transport.sendto(to_write, addr)
+        response, pending = answer(data, int(datetime.now().timestamp()))
+        if response is not None:
+            self.transport.sendto(response, addr)
+        elif pending is not None:
+            asyncio.ensure_future(self.reply(pending, addr))
 
+    async def reply(self, pending: Awaitable[bytes], addr: Tuple[str, int]):
+        self.transport.sendto(await pending, addr)
+
+
+async def serve_tcp(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    One DNS over TCP client. Every message is prefixed with its length, and
+    the connection stays open for more queries until the client closes it or
+    is idle for `tcp_idle_timeout` (RFC 7766). Pipelined queries are resolved
+    concurrently and answered in whatever order they complete.
+    """
+    tasks = set()
+
+    async def reply(pending: Awaitable[bytes]):
+        response = await pending
+        if not writer.is_closing():
+            writer.write(len(response).to_bytes(2, byteorder='big') + response)
+
+    try:
+        while True:
+            try:
+                prefix = await asyncio.wait_for(reader.readexactly(2), tcp_idle_timeout)
+                data = await asyncio.wait_for(
+                    reader.readexactly(int.from_bytes(prefix, byteorder='big')), tcp_idle_timeout
+                )
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+
+            query_stats['tcp'] += 1
+            response, pending = answer(data, int(datetime.now().timestamp()), tcp_limit)
+            if response is not None:
+                writer.write(len(response).to_bytes(2, byteorder='big') + response)
+            elif pending is not None:
+                task = asyncio.ensure_future(reply(pending))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            # stop reading while the client does not keep up with the answers
+            await writer.drain()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except ConnectionError:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+
+
+async def serve_stats(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer any HTTP request with the statistics of this process as JSON, e.g. for curl."""
+    try:
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), tcp_idle_timeout)
+        body = json.dumps(stats(), indent=2).encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                     % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def dump(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        log.info('Stats %s', json.dumps(stats()))
 
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    coro = loop.create_datagram_endpoint(
-        lambda: DNSServerProtocol(), local_addr=('0.0.0.0', 9090)
-    )
-    transport, protocol = loop.run_until_complete(coro)
+
+def serve(args: argparse.Namespace, shared_name: Optional[str] = None, worker: int = 0):
+    """
+    Run one server process, with `--workers` every worker calls this with its
+    index. Only worker 0 saves snapshots, the others would overwrite it.
+    """
+    global prefetch_fraction, shared, upstream
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(process)d %(levelname)s %(message)s')
+    prefetch_fraction = args.prefetch
+    cache.max_stale = args.serve_stale
+    if shared_name is not None:
+        shared = SharedCache(args.shared_cache, name=shared_name)
+    upstream = Upstream((get_default_resolver().nameservers[0], 53))
+    if args.snapshot:
+        now = int(datetime.now().timestamp())
+        log.info('Loaded %d entries from %s', cache.load(args.snapshot, now), args.snapshot)
+        # every worker loads the snapshot, one of them is enough to publish it
+        if shared is not None and worker == 0:
+            for question, entry in cache.entries.items():
+                shared.put(question, entry)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # with several workers the kernel spreads the clients over their sockets
+    reuse_port = args.workers > 1
+    transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: DNSServerProtocol(), local_addr=('0.0.0.0', args.port), reuse_port=reuse_port
+    ))
+    server = server_stats = None
+    if args.tcp:
+        server = loop.run_until_complete(asyncio.start_server(
+            serve_tcp, '0.0.0.0', args.port, reuse_port=reuse_port
+        ))
+    if args.stats_port:
+        # the counters are those of this process, so every worker has a port of its own
+        server_stats = loop.run_until_complete(asyncio.start_server(
+            serve_stats, '127.0.0.1', args.stats_port + worker
+        ))
+    sweeper = loop.create_task(sweep())
+    dumper = loop.create_task(dump(args.stats_interval)) if args.stats_interval else None
+    saver = None
+    if args.snapshot and worker == 0:
+        saver = loop.create_task(save(args.snapshot, args.snapshot_interval))
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
+    sweeper.cancel()
+    if dumper is not None:
+        dumper.cancel()
+    if saver is not None:
+        saver.cancel()
+        try:
+            write_snapshot(args.snapshot, int(datetime.now().timestamp()))
+        except OSError as e:
+            log.error('Snapshot to %s failed: %s', args.snapshot, e)
     transport.close()
+    for it in (server, server_stats):
+        if it is not None:
+            it.close()
+            loop.run_until_complete(it.wait_closed())
+    if shared is not None:
+        shared.close()
     loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9090)
+    # truncated UDP answers tell the client to retry over TCP, so it is on unless asked otherwise
+    parser.add_argument('--no-tcp', dest='tcp', action='store_false',
+                        help='only serve DNS over UDP, clients then cannot retry truncated answers')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server processes sharing the port through SO_REUSEPORT')
+    parser.add_argument('--shared-cache', type=int, default=0, metavar='SLOTS',
+                        help='share answers between workers in a table of SLOTS 1 KB slots')
+    parser.add_argument('--prefetch', type=float, default=prefetch_fraction,
+                        help='refresh hot entries when this fraction of their TTL is left, 0 to disable')
+    parser.add_argument('--serve-stale', type=int, default=0, metavar='SECONDS',
+                        help='serve answers up to SECONDS after expiry when the upstream fails')
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help='save the cache to PATH periodically and on exit, and load it on start')
+    parser.add_argument('--snapshot-interval', type=float, default=60.0, metavar='SECONDS')
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help='serve statistics as JSON over HTTP on this port of localhost, '
+                             'worker N of --workers serves its own on PORT + N')
+    parser.add_argument('--stats-interval', type=float, default=0, metavar='SECONDS',
+                        help='log statistics every SECONDS at the INFO level')
+    parser.add_argument('--log-level', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        serve(args)
+    else:
+        table = SharedCache(args.shared_cache) if args.shared_cache else None
+        workers = [multiprocessing.Process(target=serve, args=(args, table and table.memory.name, index))
+                   for index in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.join()
+        if table is not None:
+            table.close(unlink=True)
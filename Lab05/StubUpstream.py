@@ -0,0 +1,94 @@
+import asyncio
+import sys
+from typing import Optional, Tuple
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import dns.zone
+
+
+class StubUpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Local stand-in for an upstream DNS server. Every A question is answered
+    with the same addresses after `delay` seconds, so resolver behaviour can be
+    measured without the real internet. Names starting with "nx" do not exist.
+
+    Given a zone, it answers authoritatively from that instead, with NXDOMAIN
+    and NODATA answers carrying the SOA of the zone.
+    """
+
+    def __init__(self, delay: float = 0.0, addresses: Tuple[str, ...] = ('10.0.0.1',), ttl: int = 300,
+                 zone: Optional[dns.zone.Zone] = None):
+        self.delay = delay
+        self.addresses = addresses
+        self.ttl = ttl
+        self.zone = zone
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        request = dns.message.from_wire(data)
+        response = dns.message.make_response(request)
+        for question in request.question:
+            if self.zone is not None:
+                self.answer_from_zone(response, question)
+            elif question.name.labels[0].startswith(b'nx'):
+                response.set_rcode(dns.rcode.NXDOMAIN)
+                response.authority.append(dns.rrset.from_text(
+                    question.name.parent(), self.ttl, 'IN', 'SOA', 'ns. hostmaster. 1 3600 600 86400 30'))
+            elif question.rdtype == 1:
+                response.answer.append(dns.rrset.from_text(question.name, self.ttl, 'IN', 'A', *self.addresses))
+
+        if self.delay:
+            asyncio.get_event_loop().call_later(self.delay, self.send, response.to_wire(), addr)
+        else:
+            self.send(response.to_wire(), addr)
+
+    def send(self, data, addr):
+        # delayed answers may be due after the stub was stopped
+        if not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def answer_from_zone(self, response: dns.message.Message, question: dns.rrset.RRset):
+        if not question.name.is_subdomain(self.zone.origin):
+            response.set_rcode(dns.rcode.REFUSED)
+            return
+
+        rrset = self.zone.get_rrset(question.name, question.rdtype)
+        if rrset is not None:
+            response.answer.append(rrset)
+            return
+        if self.zone.get_node(question.name) is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        response.authority.append(self.zone.get_rrset(self.zone.origin, dns.rdatatype.SOA))
+
+
+def load_zone(path: str) -> dns.zone.Zone:
+    return dns.zone.from_file(path, relativize=False)
+
+
+async def start_stub(port: int = 0, delay: float = 0.0, ttl: int = 300, zone: Optional[dns.zone.Zone] = None):
+    loop = asyncio.get_event_loop()
+    return await loop.create_datagram_endpoint(
+        lambda: StubUpstreamProtocol(delay, ttl=ttl, zone=zone), local_addr=('127.0.0.1', port)
+    )
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5353
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    zone = load_zone(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    loop = asyncio.get_event_loop()
+    transport, protocol = loop.run_until_complete(start_stub(port, delay, zone=zone))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    transport.close()
+    loop.close()
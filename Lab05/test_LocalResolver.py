@@ -0,0 +1,125 @@
+import pytest
+
+from Lab05 import LocalResolver
+from Lab05.LocalResolver import (DNSCache, DNSFormatError, DNSQuestion, QClass, QType, ResourceRecord,
+                                 encode_name, make_query, parse_message, parse_name, parse_query, write)
+
+question = DNSQuestion('www.example.com', QType.A.value, QClass.IN.value)
+soa = (b'ns1', b'example', b'com'), (b'admin', b'example', b'com'), bytes(range(20))
+sections = (
+    [ResourceRecord((b'www', b'example', b'com'), QType.CNAME.value, QClass.IN.value, 300,
+                    [(b'web', b'example', b'com')]),
+     ResourceRecord((b'web', b'example', b'com'), QType.A.value, QClass.IN.value, 60, [bytes((192, 0, 2, 1))]),
+     ResourceRecord((b'web', b'example', b'com'), QType.A.value, QClass.IN.value, 60, [bytes((192, 0, 2, 2))])],
+    [ResourceRecord((b'example', b'com'), QType.SOA.value, QClass.IN.value, 3600, list(soa))],
+    [ResourceRecord((b'example', b'com'), QType.MX.value, QClass.IN.value, 120,
+                    [b'\x00\x0a', (b'mail', b'example', b'com')])],
+)
+
+
+def records(section):
+    return [(record.name, record.rtype, record.rclass, record.ttl, record.rdata) for record in section]
+
+
+def test_query_round_trip():
+    header, questions, questions_bytes, edns = parse_query(make_query(0x1234, question))
+    assert header.ID == 0x1234 and header.RD and not header.QR
+    assert questions == [question]
+    assert questions_bytes == encode_name(question.name()) + b'\x00\x01\x00\x01'
+    assert edns == LocalResolver.udp_payload_size
+
+
+def test_unknown_type_round_trip():
+    https = DNSQuestion('example.com', 65, QClass.IN.value)
+    _, questions, _, _ = parse_query(make_query(1, https))
+    assert questions == [https]
+    assert LocalResolver.type_name(65) == 'TYPE65'
+
+
+def test_question_name_is_lowercased():
+    data = make_query(1, DNSQuestion('WWW.Example.COM', QType.A.value, QClass.IN.value))
+    _, questions, questions_bytes, _ = parse_query(data)
+    assert questions == [question]
+    # the question section is echoed as the client sent it
+    assert b'Example' in questions_bytes
+
+
+def test_response_round_trip():
+    header, _, questions_bytes, edns = parse_query(make_query(7, question))
+    entry = DNSCache().put(question, sections, 1000)
+    data = write(header, questions_bytes, entry, 1010, 0, edns, 4096)
+
+    reply, questions, (answer, authority, additional) = parse_message(data)
+    assert reply.ID == 7 and reply.QR and reply.RA and not reply.TC
+    assert questions == [question]
+    assert records(answer) == [(r.name, r.rtype, r.rclass, r.ttl - 10, r.rdata) for r in sections[0]]
+    assert records(authority) == [(r.name, r.rtype, r.rclass, r.ttl - 10, r.rdata) for r in sections[1]]
+    # the MX record, then the OPT record
+    assert records(additional)[0] == records(sections[2])[0][:3] + (110, sections[2][0].rdata)
+    assert additional[1].rtype == QType.OPT.value
+
+
+def test_names_are_compressed():
+    entry = DNSCache().put(question, sections, 0)
+    plain = sum(len(encode_name(record.name)) + 10 + sum(len(encode_name(part)) if isinstance(part, tuple)
+                                                         else len(part) for part in record.rdata)
+                for section in sections for record in section)
+    assert len(entry.wire) < plain - 100
+    # the first owner name points to the question name, right after the header
+    assert entry.wire[:2] == b'\xc0\x0c'
+
+
+def test_truncation():
+    header, _, questions_bytes, _ = parse_query(make_query(1, question))
+    entry = DNSCache().put(question, sections, 0)
+    fixed = 12 + len(questions_bytes)
+
+    # the additional section goes first
+    data = write(header, questions_bytes, entry, 0, 0, None, fixed + entry.additional)
+    reply, _, (answer, authority, additional) = parse_message(data)
+    assert not reply.TC and len(answer) == 3 and len(authority) == 1 and not additional
+
+    data = write(header, questions_bytes, entry, 0, 0, None, fixed + entry.additional - 1)
+    reply, questions, (answer, authority, additional) = parse_message(data)
+    assert reply.TC and questions == [question] and not answer and not authority and not additional
+
+
+def test_expired_ttls_are_zero():
+    header, _, questions_bytes, _ = parse_query(make_query(1, question))
+    entry = DNSCache().put(question, sections, 0)
+    _, _, (answer, _, _) = parse_message(write(header, questions_bytes, entry, 100, 0, None, 4096))
+    assert [record.ttl for record in answer] == [200, 0, 0]
+
+
+@pytest.mark.parametrize('data', [
+    b'\x03www\x07example',          # runs past the end
+    b'\xc0\x00',                    # points to itself
+    b'\x01a\xc0\x05\x00',           # points forward
+    b'\x80abc',                     # unknown label type
+    b'\x3f' + b'a' * 63 + b'\x3f' + b'a' * 63 + b'\x3f' + b'a' * 63 + b'\x3f' + b'a' * 63 + b'\x00',  # too long
+])
+def test_bad_names(data):
+    with pytest.raises(DNSFormatError):
+        parse_name(data, 0)
+
+
+def test_compressed_name():
+    data = encode_name((b'example', b'com')) + b'\x03www\xc0\x00'
+    assert parse_name(data, 13) == ((b'www', b'example', b'com'), len(data))
+
+
+def test_snapshot_round_trip(tmp_path):
+    cache = DNSCache()
+    cache.put(question, sections, 1000)
+    https = DNSQuestion('example.com', 65, QClass.IN.value)
+    cache.put(https, ([], sections[1], []), 1000, negative_ttl=300)
+    path = tmp_path / 'cache.snapshot'
+    path.write_bytes(cache.snapshot(1010))
+
+    loaded = DNSCache()
+    assert loaded.load(str(path), 1020) == 2
+    assert list(loaded.entries) == [question, https]
+    entry = loaded.get(question, 1020)
+    assert entry.wire == cache.entries[question].wire and entry.stored == 1000
+    # the A records expire at 1060
+    assert loaded.load(str(path), 1060) == 1
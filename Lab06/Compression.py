@@ -0,0 +1,87 @@
+import os
+import stat
+import zlib
+from typing import List, Optional, Tuple
+
+from common.FileCache import FileCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this are not worth compressing
+min_size = 1024
+# bigger files are sent as they are unless a precompressed sibling exists
+max_size = 16 * 1024 * 1024
+
+compressible_types = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'image/svg+xml',
+)
+
+# preferred encoding first
+suffixes = {'br': '.br', 'gzip': '.gz'}
+
+compressed_cache = FileCache(max_bytes=32 * 1024 * 1024, max_file_size=1024 * 1024)
+
+
+def supported() -> List[str]:
+    return [it for it in suffixes if it != 'br' or brotli is not None]
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if name:
+            accepted[name] = q
+
+    result = []
+    for it in suffixes:
+        q = accepted.get(it, accepted.get('*', 0.0))
+        if q > 0:
+            result.append(it)
+    return result
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(compressible_types)
+
+
+def precompressed(path: str, encodings: List[str]) -> Optional[Tuple[str, str, os.stat_result]]:
+    for encoding in encodings:
+        sibling = path + suffixes[encoding]
+        try:
+            st = os.stat(sibling)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            return encoding, sibling, st
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data)
+    # wbits=31 writes a gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def etag_for(etag: str, encoding: str) -> str:
+    return etag[:-1] + '-' + encoding + '"'
+
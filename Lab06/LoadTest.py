@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+# the servers run as modules of the repository, they import the common package from there
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+servers = {
+    'lab04': 'Lab04.WebFileBrowser',
+    'lab06': 'Lab06.WebFileBrowser',
+}
+
+# what a request of each kind asks for, with the body length expected for a 200
+Target = Tuple[str, Dict[str, str], Optional[int]]
+
+
+class Fixture:
+    """
+    Files the servers are benchmarked on, generated once into `root`: small
+    files, a few large ones and a directory with many entries.
+    """
+
+    def __init__(self, root: str, small: int = 200, small_size: int = 8 * 1024, large: int = 2,
+                 large_size: int = 16 * 1024 * 1024, dir_entries: int = 1000, seed: int = 0):
+        self.root = root
+        rng = random.Random(seed)
+
+        os.makedirs(os.path.join(root, 'small'), exist_ok=True)
+        self.small = []
+        for i in range(small):
+            path = 'small/file{}.txt'.format(i)
+            self.small.append((path, self.make(path, rng.randint(1, small_size))))
+
+        os.makedirs(os.path.join(root, 'large'), exist_ok=True)
+        self.large = []
+        for i in range(large):
+            path = 'large/big{}.bin'.format(i)
+            self.large.append((path, self.make(path, large_size)))
+
+        self.dir = 'many'
+        os.makedirs(os.path.join(root, self.dir), exist_ok=True)
+        for i in range(dir_entries):
+            self.make('{}/entry{}'.format(self.dir, i), 0)
+
+    def make(self, path: str, size: int) -> int:
+        path = os.path.join(self.root, path)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+        return size
+
+    def target(self, kind: str, rng: random.Random) -> Target:
+        if kind == 'small':
+            path, size = rng.choice(self.small)
+            return '/' + path, {}, size
+        if kind == 'large':
+            path, size = rng.choice(self.large)
+            return '/' + path, {}, size
+        if kind == 'range':
+            path, size = rng.choice(self.large)
+            begin = rng.randrange(size)
+            end = min(size - 1, begin + rng.randint(0, 64 * 1024))
+            return '/' + path, {'Range': 'bytes={}-{}'.format(begin, end)}, size
+        return '/' + self.dir + '/', {}, None
+
+
+class Result:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[int, int] = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def summary(self, elapsed: float) -> Dict:
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        return {
+            'requests': n,
+            'errors': self.errors,
+            'statuses': {str(k): v for k, v in sorted(self.statuses.items())},
+            'rps': n / elapsed,
+            'throughput_mb': self.bytes / elapsed / 1e6,
+            'p50': latencies[n // 2] * 1000 if n else 0.0,
+            'p99': latencies[min(n - 1, n * 99 // 100)] * 1000 if n else 0.0,
+            'max': latencies[-1] * 1000 if n else 0.0,
+        }
+
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str], int]:
+    """Status, headers and body length of one response, the body is read and thrown away."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    header = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            header[key.strip().lower()] = value.strip()
+
+    if 'content-length' in header:
+        remaining = length = int(header['content-length'])
+        while remaining:
+            chunk = await reader.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+        return status, header, length
+
+    length = 0
+    while True:
+        chunk = await reader.read(1024 * 1024)
+        if not chunk:
+            return status, header, length
+        length += len(chunk)
+
+
+async def client(port: int, fixture: Fixture, kinds: List[str], weights: List[float], keep_alive: bool,
+                 deadline: float, results: Dict[str, Result], connections: List[int], seed: int):
+    """One of the concurrent clients, sends a request at a time until the deadline."""
+    rng = random.Random(seed)
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        kind = rng.choices(kinds, weights)[0]
+        uri, extra, size = fixture.target(kind, rng)
+        result = results[kind]
+
+        request = ['GET {} HTTP/1.1'.format(uri), 'Host: 127.0.0.1:{}'.format(port)]
+        request.extend('{}: {}'.format(k, v) for k, v in extra.items())
+        if not keep_alive:
+            request.append('Connection: close')
+        data = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+
+        begin = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                connections[0] += 1
+            writer.write(data)
+            status, header, length = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError):
+            result.errors += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        result.latencies.append(time.perf_counter() - begin)
+        result.statuses[status] = result.statuses.get(status, 0) + 1
+        result.bytes += length
+        # a full body that came back short counts as an error too
+        if status == 200 and size is not None and length != size:
+            result.errors += 1
+
+        if not keep_alive or header.get('connection', '').lower() == 'close':
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def rss(pid: int) -> Optional[int]:
+    """Resident set size of a process in bytes, None where /proc is not available."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def wait_ready(process: subprocess.Popen, port: int, timeout: float = 10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('server exited with status {}'.format(process.returncode))
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run(name: str, args: argparse.Namespace, fixture: Fixture, mix: Dict[str, float]) -> Dict:
+    """Start one server on the fixture, load it for the configured time and stop it again."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(it for it in (repository, env.get('PYTHONPATH')) if it)
+    process = subprocess.Popen([sys.executable, '-m', servers[name], '--port', str(args.port)],
+                               cwd=fixture.root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_ready(process, args.port)
+        kinds = list(mix)
+        weights = [mix[it] for it in kinds]
+        results = {kind: Result() for kind in kinds}
+        connections = [0]
+        rss_samples = []
+
+        begin = time.perf_counter()
+        deadline = begin + args.duration
+        clients = asyncio.gather(*[client(args.port, fixture, kinds, weights, args.keep_alive, deadline,
+                                          results, connections, args.seed + i) for i in range(args.concurrency)])
+        while not clients.done():
+            sample = rss(process.pid)
+            if sample is not None:
+                rss_samples.append(sample)
+            await asyncio.wait([clients], timeout=0.1)
+        await clients
+        elapsed = time.perf_counter() - begin
+    finally:
+        process.terminate()
+        process.wait()
+
+    total = Result()
+    for result in results.values():
+        total.latencies.extend(result.latencies)
+        total.errors += result.errors
+        total.bytes += result.bytes
+        for status, count in result.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+
+    return {
+        'server': name,
+        'keep_alive': args.keep_alive,
+        'concurrency': args.concurrency,
+        'duration': elapsed,
+        'connections': connections[0],
+        'total': total.summary(elapsed),
+        'kinds': {kind: result.summary(elapsed) for kind, result in results.items()},
+        'rss': {
+            'peak': max(rss_samples) if rss_samples else None,
+            'last': rss_samples[-1] if rss_samples else None,
+        },
+    }
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in ('small', 'large', 'range', 'dir'):
+            raise argparse.ArgumentTypeError('unknown request kind {}'.format(kind))
+        mix[kind] = float(weight)
+    return mix
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='HTTP load test of the Lab04 and Lab06 web file browsers')
+    parser.add_argument('--server', choices=('lab04', 'lab06', 'both'), default='both')
+    parser.add_argument('--port', type=int, default=8080, help='port the servers listen on')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients with a request in flight')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per server')
+    parser.add_argument('--keep-alive', action='store_true', help='reuse connections the server keeps open')
+    parser.add_argument('--mix', type=parse_mix, default='small=70,large=2,range=18,dir=10',
+                        help='relative weights of the request kinds small, large, range and dir')
+    parser.add_argument('--fixture', metavar='DIR', help='where the fixture tree is generated, reused if present')
+    parser.add_argument('--large-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH', help='write the results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    root = args.fixture or os.path.join(tempfile.gettempdir(), 'webfilebrowser-loadtest')
+    fixture = Fixture(root, large_size=args.large_size, seed=args.seed)
+
+    reports = []
+    for name in (['lab04', 'lab06'] if args.server == 'both' else [args.server]):
+        report = asyncio.run(run(name, args, fixture, args.mix))
+        reports.append(report)
+        total = report['total']
+        peak = report['rss']['peak']
+        print('{}: {} requests, {:.0f} req/s, {:.1f} MB/s, p50 {:.2f} ms, p99 {:.2f} ms, {} errors, '
+              '{} connections, peak RSS {}'.format(
+                  name, total['requests'], total['rps'], total['throughput_mb'], total['p50'], total['p99'],
+                  total['errors'], report['connections'],
+                  '{:.1f} MB'.format(peak / 1e6) if peak is not None else 'unknown'))
+        for kind, summary in report['kinds'].items():
+            print('  {:>6}: {:>6} requests, p50 {:8.2f} ms, p99 {:8.2f} ms, {} errors, statuses {}'.format(
+                kind, summary['requests'], summary['p50'], summary['p99'], summary['errors'], summary['statuses']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
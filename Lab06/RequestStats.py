@@ -0,0 +1,94 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from common.Histogram import Histogram
+
+# off by default, the server then never creates a RequestTimer and pays nothing
+enabled = False
+
+# fraction of requests run under cProfile, their profile is kept when they take longer than `profile_slow`
+profile_rate = 0.0
+profile_slow = 0.1
+# slow request profiles are written here as .prof files when set, and kept in memory either way
+profile_dir: Optional[str] = None
+slow_profiles: Deque[Dict] = deque(maxlen=20)
+
+lock = threading.Lock()
+# only one profiler can be active in a process at a time
+profile_lock = threading.Lock()
+
+stage_latency: Dict[str, Histogram] = {}
+total_latency = Histogram()
+statuses: Dict[int, int] = {}
+counters: Dict[str, int] = {'requests': 0, 'bytes': 0, 'profiled': 0}
+
+
+class RequestTimer:
+    """Time spent in every stage of one request, a stage ends where the next one is marked."""
+
+    __slots__ = ('begin', 'last', 'stages', 'profile')
+
+    def __init__(self):
+        self.begin = self.last = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+        self.profile: Optional[cProfile.Profile] = None
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def start_profile(self):
+        if profile_rate and random.random() < profile_rate and profile_lock.acquire(blocking=False):
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+
+def record(timer: RequestTimer, uri: str, status: int, sent: int):
+    total = timer.last - timer.begin
+    with lock:
+        for stage, seconds in timer.stages:
+            histogram = stage_latency.get(stage)
+            if histogram is None:
+                histogram = stage_latency[stage] = Histogram()
+            histogram.record(seconds)
+        total_latency.record(total)
+        statuses[status] = statuses.get(status, 0) + 1
+        counters['requests'] += 1
+        counters['bytes'] += sent
+
+    if timer.profile is not None:
+        timer.profile.disable()
+        profile_lock.release()
+        if total >= profile_slow:
+            keep(timer.profile, uri, total)
+
+
+def keep(profile: cProfile.Profile, uri: str, total: float):
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(15)
+    path = None
+    if profile_dir is not None:
+        path = os.path.join(profile_dir, 'request-{}-{}.prof'.format(int(time.time() * 1000), threading.get_ident()))
+        profile.dump_stats(path)
+    with lock:
+        counters['profiled'] += 1
+        slow_profiles.append({'uri': uri, 'ms': total * 1000, 'file': path, 'stats': out.getvalue()})
+
+
+def stats() -> Dict:
+    with lock:
+        return {
+            'requests': dict(counters),
+            'statuses': {str(k): v for k, v in sorted(statuses.items())},
+            'latency': total_latency.summary(),
+            'stages': {stage: histogram.summary() for stage, histogram in stage_latency.items()},
+            'slow_profiles': list(slow_profiles),
+        }
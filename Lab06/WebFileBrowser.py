@@ -1,16 +1,34 @@
+import argparse
+import json
+import logging
 import socket
 import os
 import threading
+from email.utils import formatdate, parsedate_to_datetime
 from mimetypes import MimeTypes
 from urllib.parse import unquote
-from typing import Tuple, Any, List
+from typing import Tuple, Any, List, Optional
 from typing import Dict
 
+from common import DirListing
+from common.FileCache import FileCache
+from common.HttpParser import Request, RequestParser, HttpParseError, error_page
+from . import Compression
+from . import RequestStats
+
+log = logging.getLogger('WebFileBrowser')
+
 # the root dir map to web page
 mappingDir = "."
 
-Request = Tuple[str, str, str, Dict[str, str]]
+mime = MimeTypes()
+
+# small static files are served from memory, see FileCache
+file_cache = FileCache()
+
 Respond = Tuple[Tuple[int, str], Dict[str, str], bytes]
+# the encoding picked for a response, with the precompressed sibling and its stat when one is served
+Variant = Tuple[str, Optional[str], Optional[os.stat_result]]
 
 
 class Server(threading.Thread):
@@ -20,8 +38,36 @@ class Server(threading.Thread):
         self.address = address
 
     def run(self):
-        data = self.conn.recv(10 * 1024 * 1024)
-        request = decode_request(data)
+        timer = RequestStats.RequestTimer() if RequestStats.enabled else None
+        try:
+            request = read_request(self.conn)
+        except HttpParseError as e:
+            write(error_page(e), self.conn)
+            return
+        if request is None:
+            self.conn.close()
+            return
+        method, uri, query, header = request
+        log.debug('%s %s', method, uri)
+
+        if timer is None:
+            write(make_data(self.respond(request)), self.conn)
+            return
+
+        timer.mark('read')
+        timer.start_profile()
+        status, sent = 500, 0
+        try:
+            respond = self.respond(request, timer)
+            status = respond[0][0]
+            data = make_data(respond)
+            timer.mark('serialize')
+            sent = write(data, self.conn)
+            timer.mark('write')
+        finally:
+            RequestStats.record(timer, uri, status, sent)
+
+    def respond(self, request: Request, timer: Optional[RequestStats.RequestTimer] = None) -> Respond:
         method, uri, query, header = request
 
         rel_uri = uri[1:] if uri[0] == '/' else uri
@@ -32,67 +78,48 @@ class Server(threading.Thread):
         respond[1]['Server'] = 'GoHttp/0.6'
 
         if method != 'GET' and method != 'HEAD':
-            respond = handle405(request, respond)
-            write(make_data(respond), self.conn)
-            return
-        if not os.path.exists(path):
-            respond = handle404(request, respond)
-            write(make_data(respond), self.conn)
-            return
+            return handle405(request, respond)
+        if timer is not None and uri == '/__stats':
+            return handleStats(request, respond)
+        cached = file_cache.get(path)
+        if cached is None and not os.path.exists(path):
+            return handle404(request, respond)
 
         respond = handle302(request, respond)
-        if request[0][0] == 302:
-            write(make_data(respond), self.conn)
-            return
-
-        if os.path.isdir(path):
-            respond = handleDir(request, respond)
+        if respond[0][0] == 302:
+            return respond
+        if timer is not None:
+            timer.mark('route')
+
+        if cached is not None:
+            file_header, body, st = cached
+            respond[1].update(file_header)
+            respond = handleEncoding(request, (respond[0], respond[1], body), st)
+        elif os.path.isdir(path):
+            respond = handleEncoding(request, handleDir(request, respond), None)
         else:
             respond = handleFile(request, respond)
+        if timer is not None:
+            timer.mark('handle')
 
         respond = handleRange(request, respond)
+        if timer is not None:
+            timer.mark('range')
 
         if method == 'HEAD':
-            write(make_data((respond[0], respond[1], b'')), self.conn)
-            return
-
-        write(make_data(respond), self.conn)
-
-
-def decode_request(data: bytes) -> Request:
-    index = data.index(b'\r\n')
-    request_line = data[0:index].decode()
-
-    method: str
-    uri: str
-    method, uri, _ = request_line.split()
-
-    print(request_line)
-    data = data[index + 2:]
+            return respond[0], respond[1], b''
+        return respond
 
-    query: str = ''
-    if '?' in uri:
-        index = uri.index('?')
-        query = uri[index + 1:]
-        uri = uri[:index]
 
-    header = {}
+def read_request(conn: socket.socket) -> Optional[Request]:
+    parser = RequestParser()
     while True:
-        index = data.index(b'\r\n')
-        line = data[0:index].decode()
-
-        print(line)
-        data = data[index + 2:]
-
-        if not line:
-            break
-
-        colon = line.index(":")
-        name: str = line[0: colon]
-        value: str = line[colon + 1:]
-        header[name.strip().lower()] = value.strip()
-
-    return method, uri, query, header
+        data = conn.recv(64 * 1024)
+        if not data:
+            return None
+        requests = parser.feed(data)
+        if requests:
+            return requests[0]
 
 
 def handle405(request, respond) -> Respond:
@@ -107,6 +134,13 @@ def handle404(request, respond):
     return status, respond[1], body
 
 
+def handleStats(request: Request, respond: Respond) -> Respond:
+    body = json.dumps(RequestStats.stats(), indent=2).encode('utf-8')
+    respond[1]['Content-Type'] = 'application/json'
+    respond[1]['Content-Length'] = str(len(body))
+    return respond[0], respond[1], body
+
+
 def handle302(request, respond):
     method, uri, query, header = request
 
@@ -140,25 +174,7 @@ def handleDir(request: Request, respond: Respond) -> Respond:
     respond[1]['Content-Type'] = 'text/html; charset=utf-8'
     respond[1]['Set-Cookie'] = 'visit={}; path=/'.format(uri)
 
-    body = b''
-    body += b'<html>\r\n'
-    body += '<head><title>Index of /{}</title></head>\r\n'.format(unquote_uri).encode('utf-8')
-    body += b'<body bgcolor="white">\r\n'
-    body += '<h1>Index of /{}</h1><hr><pre>\r\n'.format(unquote_uri).encode('utf-8')
-
-    if uri == '/':
-        body += '<a href="/">..</a>\r\n'.encode('utf-8')
-    else:
-        body += '<a href="../">..</a>\r\n'.encode('utf-8')
-
-    for it in os.listdir(path):
-        abs_path = os.path.join(path, it)
-        if os.path.isdir(abs_path):
-            it += '/'
-        body += '<a href="{}">{}</a>\r\n'.format(it, it).encode('utf-8')
-
-    body += b'</pre><hr></body>\r\n'
-    body += b'</html>\r\n'
+    body = DirListing.render(path, uri, unquote_uri, query)
 
     return respond[0], respond[1], body
 
@@ -170,20 +186,151 @@ def handleFile(request: Request, respond: Respond) -> Respond:
     unquote_uri = unquote(rel_uri)
     path = os.path.join(mappingDir, unquote_uri)
 
-    guess = MimeTypes().guess_type(path)
-    mine_type = guess[0] if guess else "application/octet-stream"
-
-    file_size = os.path.getsize(path)
-
-    respond[1]['Accept-Ranges'] = 'bytes'
-    respond[1]['Content-Type'] = mine_type
-    respond[1]['Content-Length'] = str(file_size)
+    guess = mime.guess_type(path)
+    mine_type = guess[0] or "application/octet-stream"
 
     file = open(path, 'rb')
+    # the signature of the open file, a file replaced after this is never cached under it
+    st = os.fstat(file.fileno())
+
+    file_header = {
+        'Accept-Ranges': 'bytes',
+        'Content-Type': mine_type,
+        'Content-Length': str(st.st_size),
+        'ETag': make_etag(st),
+        'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+    }
+    respond[1].update(file_header)
+
+    variant = negotiate_encoding(request, respond, st.st_size)
+    respond = handle304(request, respond)
+    if respond[0][0] == 304:
+        file.close()
+        return respond
+
     body = file.read()
     file.close()
 
-    return respond[0], respond[1], body
+    file_cache.put(path, st, (file_header, body, st), len(body))
+
+    respond = respond[0], respond[1], body
+    if variant is not None:
+        respond = encode_body(request, respond, variant, st)
+    return respond
+
+
+def make_etag(st: os.stat_result) -> str:
+    return '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def handle304(request: Request, respond: Respond) -> Respond:
+    method, uri, query, header = request
+    respond_status, respond_header, body = respond
+
+    etag = respond_header.get('ETag')
+    last_modified = respond_header.get('Last-Modified')
+
+    not_modified = False
+    if 'if-none-match' in header:
+        # If-Modified-Since is ignored when If-None-Match is present
+        tags = [it.strip() for it in header['if-none-match'].split(',')]
+        tags = [it[2:] if it.startswith('W/') else it for it in tags]
+        not_modified = etag is not None and ('*' in tags or etag in tags)
+    elif 'if-modified-since' in header and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(header['if-modified-since'])
+            not_modified = parsedate_to_datetime(last_modified) <= since
+        except (TypeError, ValueError):
+            pass
+
+    if not not_modified:
+        return respond
+
+    respond_header.pop('Content-Length', None)
+    return (304, 'Not Modified'), respond_header, b''
+
+
+# the encoding is picked and the validators of that variant are set before handle304
+# compares them, the body is only read and compressed when it is actually sent
+def handleEncoding(request: Request, respond: Respond, st: Optional[os.stat_result]) -> Respond:
+    variant = negotiate_encoding(request, respond, len(respond[2]))
+    respond = handle304(request, respond)
+    if variant is None or respond[0][0] != 200:
+        return respond
+    return encode_body(request, respond, variant, st)
+
+
+def negotiate_encoding(request: Request, respond: Respond, size: int) -> Optional[Variant]:
+    method, uri, query, header = request
+    respond_status, respond_header, body = respond
+
+    # partial content is always served from the identity encoding
+    if respond_status[0] != 200 or 'range' in header:
+        return None
+    if not Compression.is_compressible(respond_header.get('Content-Type', '')):
+        return None
+
+    respond_header['Vary'] = 'Accept-Encoding'
+    encodings = Compression.accepted_encodings(header.get('accept-encoding', ''))
+    if not encodings:
+        return None
+
+    rel_uri = uri[1:] if uri[0] == '/' else uri
+    path = os.path.join(mappingDir, unquote(rel_uri))
+    etag = respond_header.get('ETag')
+
+    variant = None
+    if etag is not None:
+        found = Compression.precompressed(path, encodings)
+        if found is not None:
+            encoding, sibling, sibling_st = found
+            # the sibling is a file of its own, when it goes stale its validators change too
+            respond_header['ETag'] = Compression.etag_for(make_etag(sibling_st), encoding)
+            respond_header['Last-Modified'] = formatdate(sibling_st.st_mtime, usegmt=True)
+            respond_header['Content-Length'] = str(sibling_st.st_size)
+            variant = found
+
+    if variant is None:
+        encodings = [it for it in encodings if it in Compression.supported()]
+        if not encodings or not Compression.min_size <= size <= Compression.max_size:
+            return None
+        variant = encodings[0], None, None
+        if etag is not None:
+            respond_header['ETag'] = Compression.etag_for(etag, variant[0])
+        # only known once the body is compressed
+        respond_header.pop('Content-Length', None)
+
+    respond_header['Content-Encoding'] = variant[0]
+    return variant
+
+
+# st is the stat the body was read with, compressed copies are cached under it
+# so that a file changed since then is never served a stale copy
+def encode_body(request: Request, respond: Respond, variant: Variant, st: Optional[os.stat_result]) -> Respond:
+    method, uri, query, header = request
+    respond_status, respond_header, body = respond
+    encoding, sibling, sibling_st = variant
+    cache = Compression.compressed_cache
+
+    if sibling is not None:
+        data = cache.get(sibling)
+        if data is None:
+            file = open(sibling, 'rb')
+            data = file.read()
+            cache.put(sibling, os.fstat(file.fileno()), data, len(data))
+            file.close()
+    else:
+        rel_uri = uri[1:] if uri[0] == '/' else uri
+        path = os.path.join(mappingDir, unquote(rel_uri))
+        key = path + '\0' + encoding
+        data = cache.get(path, key) if st is not None else None
+        if data is None:
+            data = Compression.compress(body, encoding)
+            if st is not None:
+                cache.put(path, st, data, len(data), key)
+
+    respond_header['Content-Length'] = str(len(data))
+    return respond_status, respond_header, data
 
 
 def handleRange(request: Request, respond: Respond) -> Respond:
@@ -194,7 +341,12 @@ def handleRange(request: Request, respond: Respond) -> Respond:
     respond_status, respond_header, body = respond
     file_size = len(body)
 
-    if 'range' not in header:
+    if 'range' not in header or respond_status[0] != 200:
+        return respond
+
+    # a stale If-Range validator means the client wants the whole new file
+    if 'if-range' in header and header['if-range'] not in (respond_header.get('ETag'),
+                                                         respond_header.get('Last-Modified')):
         return respond
 
     try:
@@ -244,14 +396,17 @@ def make_data(respond: Respond) -> bytes:
     return data
 
 
-def write(data: bytes, conn: socket.socket):
-    conn.send(data)
+def write(data: bytes, conn: socket.socket) -> int:
+    conn.sendall(data)
     conn.close()
+    return len(data)
 
 
-def web():
+def web(port: int = 8080):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('0.0.0.0', 8080))
+    # restarting must not wait for the connections of the previous run to leave TIME_WAIT
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
     sock.listen(10)
     while True:
         conn, address = sock.accept()
@@ -259,7 +414,24 @@ def web():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--stats', action='store_true',
+                        help='time every request stage and serve the results at /__stats')
+    parser.add_argument('--profile-rate', type=float, default=0.0, metavar='FRACTION',
+                        help='run this fraction of requests under cProfile, needs --stats')
+    parser.add_argument('--profile-slow', type=float, default=100.0, metavar='MS',
+                        help='keep the profiles of sampled requests slower than this')
+    parser.add_argument('--profile-dir', metavar='DIR', help='also write kept profiles to DIR as .prof files')
+    parser.add_argument('--log-level', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    RequestStats.enabled = args.stats
+    RequestStats.profile_rate = args.profile_rate
+    RequestStats.profile_slow = args.profile_slow / 1000
+    RequestStats.profile_dir = args.profile_dir
     try:
-        web()
+        web(args.port)
     except KeyboardInterrupt:
         exit()
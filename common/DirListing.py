@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlencode
+from typing import Callable, Dict, List, Tuple
+
+# the biggest page a directory listing will produce, use ?page=N to see the rest
+page_size = 1000
+
+# DirEntry.stat() keeps its first result, and a file can change without the mtime of its
+# directory changing, so the size and mtime are read again every time
+sort_keys: Dict[str, Callable[[os.DirEntry], object]] = {
+    'name': lambda it: it.name,
+    'size': lambda it: os.stat(it.path).st_size,
+    'mtime': lambda it: os.stat(it.path).st_mtime_ns,
+}
+
+# sorts that only depend on the directory itself, their order is kept with the listing
+cached_sorts = ('name',)
+
+
+class Listing:
+    def __init__(self, sig: Tuple[int, int], entries: List[os.DirEntry]):
+        self.sig = sig
+        self.entries = entries
+        self.lines: Dict[str, bytes] = {}
+        # sorted lines for each cached (sort, order), built on demand
+        self.orders: Dict[Tuple[str, bool], List[bytes]] = {}
+        for it in entries:
+            name = it.name + '/' if it.is_dir() else it.name
+            self.lines[it.name] = '<a href="{}">{}</a>\r\n'.format(name, name).encode('utf-8')
+
+    def sorted_lines(self, sort: str, reverse: bool) -> List[bytes]:
+        key = (sort, reverse)
+        lines = self.orders.get(key)
+        if lines is None:
+            try:
+                entries = sorted(self.entries, key=sort_keys[sort], reverse=reverse)
+            except OSError:
+                # an entry disappeared after the scan, fall back to the name order
+                entries = sorted(self.entries, key=sort_keys['name'], reverse=reverse)
+            lines = [self.lines[it.name] for it in entries]
+            if sort in cached_sorts:
+                self.orders[key] = lines
+        return lines
+
+
+class DirListingCache:
+    """
+    Directory listings built with os.scandir, cached per directory and
+    rebuilt only when the directory's mtime changes. Only the name order
+    is kept, sorting by size or mtime stats the entries again.
+    """
+
+    def __init__(self, max_dirs: int = 256):
+        self.max_dirs = max_dirs
+        self.listings: OrderedDict[str, Listing] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str) -> Listing:
+        st = os.stat(path)
+        sig = (st.st_ino, st.st_mtime_ns)
+
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing.sig == sig:
+                self.listings.move_to_end(path)
+                self.hits += 1
+                return listing
+            self.misses += 1
+
+        with os.scandir(path) as it:
+            listing = Listing(sig, list(it))
+
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.max_dirs:
+                self.listings.popitem(last=False)
+        return listing
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'dirs': len(self.listings), 'hits': self.hits, 'misses': self.misses}
+
+
+dir_cache = DirListingCache()
+
+
+def render(path: str, uri: str, unquote_uri: str, query: str) -> bytes:
+    params = parse_qs(query)
+    sort = params.get('sort', ['name'])[0]
+    if sort not in sort_keys:
+        sort = 'name'
+    order = params.get('order', ['asc'])[0]
+    reverse = order == 'desc'
+    try:
+        page = max(1, int(params.get('page', ['1'])[0]))
+    except ValueError:
+        page = 1
+
+    lines = dir_cache.get(path).sorted_lines(sort, reverse)
+    pages = max(1, (len(lines) + page_size - 1) // page_size)
+    page = min(page, pages)
+
+    body = [
+        b'<html>\r\n',
+        '<head><title>Index of /{}</title></head>\r\n'.format(unquote_uri).encode('utf-8'),
+        b'<body bgcolor="white">\r\n',
+        '<h1>Index of /{}</h1><hr><pre>\r\n'.format(unquote_uri).encode('utf-8'),
+        b'<a href="/">..</a>\r\n' if uri == '/' else b'<a href="../">..</a>\r\n',
+    ]
+    body.extend(lines[(page - 1) * page_size:page * page_size])
+    body.append(b'</pre><hr>')
+
+    if pages > 1:
+        def link(to: int, text: str) -> bytes:
+            href = '?' + urlencode({'sort': sort, 'order': order, 'page': to})
+            return '<a href="{}">{}</a> '.format(href, text).encode('utf-8')
+
+        if page > 1:
+            body.append(link(page - 1, 'prev'))
+        body.append('page {} of {} '.format(page, pages).encode('utf-8'))
+        if page < pages:
+            body.append(link(page + 1, 'next'))
+        body.append(b'<hr>')
+
+    body.append(b'</body>\r\n')
+    body.append(b'</html>\r\n')
+    return b''.join(body)
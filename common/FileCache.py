@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# (inode, size, mtime) of a file, changes whenever the file is replaced or modified
+Signature = Tuple[int, int, int]
+
+
+def signature(st: os.stat_result) -> Signature:
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class CacheEntry:
+    def __init__(self, sig: Signature, value: Any, size: int, checked: float):
+        self.sig = sig
+        self.value = value
+        self.size = size
+        self.checked = checked
+
+
+class FileCache:
+    """
+    LRU cache of prebuilt responses for small static files.
+
+    An entry is trusted for `revalidate` seconds after it was last checked,
+    after that the file is stat-ed again and the entry is dropped if its
+    inode, size or mtime changed.
+
+    Entries are keyed by path unless an explicit key is given, which allows
+    several variants (e.g. compressed ones) of the same file to be cached.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entries: int = 4096,
+                 max_file_size: int = 256 * 1024, revalidate: float = 1.0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.revalidate = revalidate
+
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, path: str, key: Optional[str] = None) -> Optional[Any]:
+        key = path if key is None else key
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            now = time.monotonic()
+            if now - entry.checked < self.revalidate:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry.value
+
+        # stat-ed without the lock, a slow file system holds up no other lookup
+        try:
+            sig = signature(os.stat(path))
+        except OSError:
+            sig = None
+
+        with self.lock:
+            current = self.entries.get(key) is entry
+            if sig != entry.sig:
+                if current:
+                    self._remove(key)
+                    self.invalidations += 1
+                self.misses += 1
+                return None
+            entry.checked = now
+            if current:
+                self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, path: str, st: os.stat_result, value: Any, size: int, key: Optional[str] = None) -> bool:
+        if size > self.max_file_size or size > self.max_bytes:
+            return False
+
+        key = path if key is None else key
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = CacheEntry(signature(st), value, size, time.monotonic())
+            self.bytes += size
+
+            while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
@@ -0,0 +1,150 @@
+import time
+from typing import Dict, List, Tuple
+
+# method, uri, query, header
+Request = Tuple[str, str, str, Dict[str, str]]
+
+
+class HttpParseError(Exception):
+    def __init__(self, status: int, reason: str):
+        super().__init__('{} {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class RequestParser:
+    """
+    Incremental HTTP/1.x request parser.
+
+    Data is fed in chunks of any size, complete requests are returned as soon
+    as their header block ends. The buffer is only compacted once per feed and
+    the search for the end of the header resumes where the last one stopped,
+    so the cost stays linear in the size of the input.
+    """
+
+    def __init__(self, max_header_size: int = 64 * 1024, max_headers: int = 100):
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+
+        self.buffer = bytearray()
+        # where the search for the end of the current header continues
+        self.scan = 0
+        # bytes of the current request body that have not arrived yet
+        self.body_left = 0
+
+    def feed(self, data: bytes) -> List[Request]:
+        buffer = self.buffer
+        buffer += data
+
+        requests = []
+        start = 0
+        while True:
+            if self.body_left:
+                skip = min(self.body_left, len(buffer) - start)
+                start += skip
+                self.body_left -= skip
+                if self.body_left:
+                    break
+
+            # empty lines in front of a request line are ignored
+            while buffer.startswith(b'\r\n', start):
+                start += 2
+
+            end = buffer.find(b'\r\n\r\n', max(start, self.scan - 3))
+            if end < 0:
+                if len(buffer) - start > self.max_header_size:
+                    raise HttpParseError(431, 'Request Header Fields Too Large')
+                self.scan = len(buffer)
+                break
+            if end - start > self.max_header_size:
+                raise HttpParseError(431, 'Request Header Fields Too Large')
+
+            request = self.parse_head(bytes(memoryview(buffer)[start:end]))
+            requests.append(request)
+            start = end + 4
+            self.scan = start
+
+            length = request[3].get('content-length')
+            if length is not None:
+                if not length.isdigit():
+                    raise HttpParseError(400, 'Bad Request')
+                self.body_left = int(length)
+
+        del buffer[:start]
+        self.scan = max(0, self.scan - start)
+        return requests
+
+    def parse_head(self, head: bytes) -> Request:
+        lines = head.decode('utf-8', errors='replace').split('\r\n')
+
+        parts = lines[0].split(' ')
+        # only origin-form targets are served, anything else would leave no path to route on
+        if len(parts) != 3 or not parts[1].startswith('/') or not parts[2].startswith('HTTP/'):
+            raise HttpParseError(400, 'Bad Request')
+        method, uri, _ = parts
+
+        query: str = ''
+        if '?' in uri:
+            index = uri.index('?')
+            query = uri[index + 1:]
+            uri = uri[:index]
+
+        if len(lines) - 1 > self.max_headers:
+            raise HttpParseError(431, 'Request Header Fields Too Large')
+
+        header = {}
+        for line in lines[1:]:
+            colon = line.find(':')
+            # obsolete line folding is rejected as RFC 7230 allows
+            if colon <= 0 or line[0] in ' \t':
+                raise HttpParseError(400, 'Bad Request')
+            header[line[:colon].strip().lower()] = line[colon + 1:].strip()
+
+        if 'transfer-encoding' in header:
+            raise HttpParseError(501, 'Not Implemented')
+
+        return method, uri, query, header
+
+
+def error_page(error: HttpParseError) -> bytes:
+    body = '<html><body>{} {}<body></html>'.format(error.status, error.reason).encode('utf-8')
+    data = 'HTTP/1.1 {} {}\r\n'.format(error.status, error.reason).encode('utf-8')
+    data += b'Connection: close\r\n'
+    data += b'Content-Type: text/html; charset=utf-8\r\n'
+    data += 'Content-Length: {}\r\n'.format(len(body)).encode('utf-8')
+    data += b'\r\n'
+    return data + body
+
+
+if __name__ == '__main__':
+    # parser micro benchmark
+    sample = (b'GET /Lab04/WebFileBrowser.py?x=1 HTTP/1.1\r\n'
+              b'Host: 127.0.0.1:8080\r\n'
+              b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:70.0) Gecko/20100101 Firefox/70.0\r\n'
+              b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+              b'Accept-Language: en-US,en;q=0.5\r\n'
+              b'Accept-Encoding: gzip, deflate\r\n'
+              b'Connection: keep-alive\r\n'
+              b'Cookie: visit=/Lab04/\r\n'
+              b'Upgrade-Insecure-Requests: 1\r\n'
+              b'\r\n')
+    n = 50000
+
+    for name, chunk in (('whole request', len(sample)), ('64 byte chunks', 64), ('7 byte chunks', 7)):
+        parser = RequestParser()
+        pieces = [sample[i:i + chunk] for i in range(0, len(sample), chunk)]
+        count = 0
+        begin = time.perf_counter()
+        for _ in range(n):
+            for piece in pieces:
+                count += len(parser.feed(piece))
+        elapsed = time.perf_counter() - begin
+        assert count == n
+        print('{:>16}: {:>10.0f} requests/sec'.format(name, n / elapsed))
+
+    parser = RequestParser()
+    begin = time.perf_counter()
+    count = len(parser.feed(sample * n))
+    elapsed = time.perf_counter() - begin
+    assert count == n
+    print('{:>16}: {:>10.0f} requests/sec'.format('pipelined', n / elapsed))
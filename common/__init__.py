@@ -0,0 +1 @@
+"""Code shared by the labs, run them from the repository root, e.g. python -m Lab06.WebFileBrowser."""
@@ -0,0 +1,73 @@
+import pytest
+
+from common.HttpParser import HttpParseError, RequestParser, error_page
+
+sample = (b'GET /dir/a%20b.txt?sort=size&order=desc HTTP/1.1\r\n'
+          b'Host: 127.0.0.1:8080\r\n'
+          b'Accept-Encoding: gzip, br\r\n'
+          b'If-None-Match:  "1-2-3" \r\n'
+          b'\r\n')
+expected = ('GET', '/dir/a%20b.txt', 'sort=size&order=desc',
+            {'host': '127.0.0.1:8080', 'accept-encoding': 'gzip, br', 'if-none-match': '"1-2-3"'})
+
+
+def test_whole_request():
+    assert RequestParser().feed(sample) == [expected]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64])
+def test_request_in_chunks(size):
+    parser = RequestParser()
+    requests = []
+    for i in range(0, len(sample), size):
+        requests += parser.feed(sample[i:i + size])
+    assert requests == [expected]
+    assert len(parser.buffer) == 0
+
+
+def test_pipelined_requests_and_bodies():
+    post = b'POST /form HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+    parser = RequestParser()
+    requests = parser.feed(sample + post + b'\r\n' + sample[:10])
+    assert requests == [expected, ('POST', '/form', '', {'content-length': '5'})]
+    assert parser.feed(sample[10:]) == [expected]
+
+
+@pytest.mark.parametrize('line', [
+    b'GET ?x HTTP/1.1',
+    b'GET http://example.com/ HTTP/1.1',
+    b'GET / FTP/1.0',
+    b'GET /',
+    b'GET  / HTTP/1.1',
+])
+def test_bad_request_line(line):
+    with pytest.raises(HttpParseError) as info:
+        RequestParser().feed(line + b'\r\n\r\n')
+    assert info.value.status == 400
+
+
+def test_bad_header_lines():
+    for line in (b'no colon', b': empty name', b' folded: value'):
+        with pytest.raises(HttpParseError) as info:
+            RequestParser().feed(b'GET / HTTP/1.1\r\n' + line + b'\r\n\r\n')
+        assert info.value.status == 400
+
+
+def test_limits():
+    with pytest.raises(HttpParseError) as info:
+        RequestParser(max_header_size=100).feed(b'GET / HTTP/1.1\r\nX: ' + b'x' * 200)
+    assert info.value.status == 431
+    with pytest.raises(HttpParseError) as info:
+        RequestParser(max_headers=2).feed(b'GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n')
+    assert info.value.status == 431
+    with pytest.raises(HttpParseError) as info:
+        RequestParser().feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+    assert info.value.status == 501
+
+
+def test_error_page():
+    data = error_page(HttpParseError(400, 'Bad Request'))
+    head, body = data.split(b'\r\n\r\n', 1)
+    lines = head.split(b'\r\n')
+    assert lines[0] == b'HTTP/1.1 400 Bad Request'
+    assert b'Content-Length: %d' % len(body) in lines
@@ -0,0 +1,216 @@
+import struct
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+# first byte of an FEC datagram, a plain packet starts with its flags, which never set 0x10
+FEC_MAGIC = 0xB0
+# magic, parity symbols per codeword of the body, parity the sender wants back, body data length
+HeaderStruct = struct.Struct('!BBBI')
+# the header is a codeword of its own with a fixed strength, the body strength is read from it
+header_t = 3
+header_size = HeaderStruct.size + 2 * header_t
+max_t = 16
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+
+def mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def inv(a: int) -> int:
+    return EXP[255 - LOG[a]]
+
+
+def evaluate(poly: List[int], x: int) -> int:
+    """Value of a polynomial given lowest degree first."""
+    y = 0
+    for c in reversed(poly):
+        y = mul(y, x) ^ c
+    return y
+
+
+# MUL[c] multiplies every byte of a buffer by c with bytes.translate
+MUL = [bytes(mul(c, x) for x in range(256)) for c in range(256)]
+
+
+def generator(t: int) -> List[int]:
+    """(x - a^0) .. (x - a^(2t-1)), highest degree first."""
+    poly = [1]
+    for i in range(2 * t):
+        poly = [c ^ mul(d, EXP[i]) for c, d in zip(poly + [0], [0] + poly)]
+    return poly
+
+
+generators = [generator(t) for t in range(max_t + 1)]
+
+
+def parity(rows: List[bytes], t: int, m: int) -> List[bytes]:
+    """
+    Parity rows of m codewords at once, row j holds symbol j of every
+    codeword, so each step is a bytes.translate over all of them.
+    """
+    if t == 0:
+        return []
+    gen = generators[t]
+    remainder = [0] * (2 * t)
+    for row in rows:
+        feedback = (int.from_bytes(row, 'big') ^ remainder[0]).to_bytes(m, 'big')
+        remainder = remainder[1:] + [0]
+        for i in range(2 * t):
+            if gen[i + 1]:
+                remainder[i] ^= int.from_bytes(feedback.translate(MUL[gen[i + 1]]), 'big')
+    return [it.to_bytes(m, 'big') for it in remainder]
+
+
+def syndromes(rows: List[bytes], t: int, m: int) -> List[bytes]:
+    """The 2t syndromes of m codewords at once, all zero for a codeword without errors."""
+    result = []
+    for i in range(2 * t):
+        table = MUL[EXP[i]]
+        s = bytes(m)
+        for row in rows:
+            s = (int.from_bytes(s.translate(table), 'big') ^ int.from_bytes(row, 'big')).to_bytes(m, 'big')
+        result.append(s)
+    return result
+
+
+def correct(codeword: bytearray, s: List[int]) -> int:
+    """
+    Fixes up to t wrong symbols of one codeword in place from its 2t
+    syndromes, with Berlekamp-Massey, a Chien search and Forney's formula.
+    Returns the number fixed, -1 when there were too many.
+    """
+    # error locator, lowest degree first
+    locator, previous = [1], [1]
+    errors, shift, last = 0, 1, 1
+    for n in range(len(s)):
+        d = s[n]
+        for i in range(1, min(errors, len(locator) - 1) + 1):
+            d ^= mul(locator[i], s[n - i])
+        if d == 0:
+            shift += 1
+            continue
+        scale = mul(d, inv(last))
+        updated = locator + [0] * max(0, len(previous) + shift - len(locator))
+        for i, c in enumerate(previous):
+            updated[i + shift] ^= mul(scale, c)
+        if 2 * errors <= n:
+            previous, last = locator, d
+            errors = n + 1 - errors
+            shift = 1
+        else:
+            shift += 1
+        locator = updated
+    if errors > len(s) // 2:
+        return -1
+
+    n = len(codeword)
+    positions = [j for j in range(n) if evaluate(locator, EXP[255 - (n - 1 - j)]) == 0]
+    if len(positions) != errors:
+        return -1
+
+    evaluator = [0] * len(s)
+    for i, a in enumerate(s):
+        for j, b in enumerate(locator[:len(s) - i]):
+            evaluator[i + j] ^= mul(a, b)
+    derivative = [c if i % 2 == 0 else 0 for i, c in enumerate(locator[1:])]
+    for j in positions:
+        x = EXP[n - 1 - j]
+        x_inv = EXP[255 - (n - 1 - j)]
+        codeword[j] ^= mul(x, mul(evaluate(evaluator, x_inv), inv(evaluate(derivative, x_inv))))
+    return errors
+
+
+def encode_block(data: bytes, t: int) -> bytes:
+    """
+    `data` as m interleaved codewords of at most 255 symbols, 2t of them
+    parity. Symbol j of every codeword is sent together, the data first.
+    """
+    m = max(1, -(-len(data) // (255 - 2 * t)))
+    k = max(1, -(-len(data) // m))
+    data = data.ljust(m * k, b'\x00')
+    rows = [data[j::k] for j in range(k)]
+    return b''.join(rows + parity(rows, t, m))
+
+
+def decode_block(block: bytes, length: int, t: int) -> Tuple[Optional[bytes], int]:
+    """The data of a block and the most errors fixed in one codeword, None if it could not be fixed."""
+    m = max(1, -(-length // (255 - 2 * t)))
+    k = max(1, -(-length // m))
+    n = k + 2 * t
+    if len(block) != m * n:
+        return None, t + 1
+
+    worst = 0
+    if t:
+        rows = [block[j * m:(j + 1) * m] for j in range(n)]
+        s = syndromes(rows, t, m)
+        bad = [c for c in range(m) if any(it[c] for it in s)]
+        if bad:
+            block = bytearray(block)
+            for c in bad:
+                codeword = bytearray(block[c::m])
+                fixed = correct(codeword, [it[c] for it in s])
+                if fixed < 0:
+                    return None, t + 1
+                block[c::m] = codeword
+                worst = max(worst, fixed)
+    data = b''.join(block[c:m * k:m] for c in range(m))
+    return bytes(data[:length]), worst
+
+
+class Codec:
+    """
+    Reed-Solomon coding of whole datagrams, so that one with a few corrupted
+    bytes is fixed by the receiver instead of dropped and retransmitted.
+
+    Every datagram carries the parity the peer should use, the most errors
+    in a codeword of the last `window` datagrams received plus one when one
+    could not be fixed, so the overhead follows the corruption observed.
+    """
+
+    def __init__(self, t: int = header_t, window: int = 32):
+        self.t = t
+        self.needed: Deque[int] = deque(maxlen=window)
+        self.last_t = t
+
+    def hint(self) -> int:
+        return min(max_t, max(self.needed)) if self.needed else self.t
+
+    def encode(self, data: bytes) -> bytes:
+        header = HeaderStruct.pack(FEC_MAGIC, self.t, self.hint(), len(data))
+        return encode_block(header, header_t) + encode_block(data, self.t)
+
+    def decode(self, datagram: bytes) -> Optional[bytes]:
+        """The data of an FEC datagram, None if it is not one or could not be fixed."""
+        header, _ = decode_block(datagram[:header_size], HeaderStruct.size, header_t)
+        if header is None:
+            return None
+        magic, t, hint, length = HeaderStruct.unpack(header)
+        if magic != FEC_MAGIC or t > max_t or hint > max_t:
+            return None
+        self.t = hint
+
+        data, needed = decode_block(datagram[header_size:], length, t)
+        self.needed.append(needed)
+        self.last_t = t
+        return data
+
+    def failed(self):
+        """The data of the last datagram turned out wrong, it had more errors than its parity finds."""
+        if self.needed:
+            self.needed[-1] = min(max_t, self.last_t + 1)
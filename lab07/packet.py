@@ -3,6 +3,10 @@ class Packet:
         self.SYN = False
         self.ACK = False
         self.FIN = False
+        # stream header, only sent for a stream other than 0
+        self.stream = 0
+        self.END = False
+        self.WND = False
         self.seq = 0
         self.ack = 0
         self.LEN = 0
@@ -18,11 +22,21 @@ class Packet:
             flag += 0x4000
         if self.FIN:
             flag += 0x2000
+        if self.stream:
+            flag += 0x0800
         data += int.to_bytes(flag, 2, byteorder='big')
         data += int.to_bytes(self.seq, 4, byteorder='big')
         data += int.to_bytes(self.ack, 4, byteorder='big')
         data += int.to_bytes(self.LEN, 4, byteorder='big')
         data += int.to_bytes(self.CHECKSUM, 2, byteorder='big')
+        if self.stream:
+            stream_flag = 0
+            if self.END:
+                stream_flag += 0x8000
+            if self.WND:
+                stream_flag += 0x4000
+            data += int.to_bytes(self.stream, 2, byteorder='big')
+            data += int.to_bytes(stream_flag, 2, byteorder='big')
         data += self.payload
 
         if self.LEN % 2 == 1:
@@ -45,6 +59,14 @@ class Packet:
         packet.LEN = int.from_bytes(byte[10:14], byteorder='big')
         packet.CHECKSUM = int.from_bytes(byte[14:16], byteorder='big')
         packet.payload = byte[16:]
+        if flag & 0x0800 != 0:
+            packet.stream = int.from_bytes(byte[16:18], byteorder='big')
+            stream_flag = int.from_bytes(byte[18:20], byteorder='big')
+            if stream_flag & 0x8000 != 0:
+                packet.END = True
+            if stream_flag & 0x4000 != 0:
+                packet.WND = True
+            packet.payload = byte[20:]
 
         if packet.LEN % 2 == 1:
             packet.payload = packet.payload[:-1]
@@ -55,11 +77,14 @@ class Packet:
         return packet
 
     @staticmethod
-    def create(seq=0, ack=0, data=b'', SYN=False, ACK=False, FIN=False):
+    def create(seq=0, ack=0, data=b'', SYN=False, ACK=False, FIN=False, stream=0, END=False, WND=False):
         packet = Packet()
         packet.ACK = ACK
         packet.FIN = FIN
         packet.SYN = SYN
+        packet.stream = stream
+        packet.END = END
+        packet.WND = WND
 
         packet.seq = seq
         packet.ack = ack
@@ -94,6 +119,12 @@ class Packet:
             res += "\033[91mFIN\033[0m "
 
         res += "["
+        if self.stream:
+            res += "stream={}, ".format(self.stream)
+            if self.END:
+                res += "END, "
+            if self.WND:
+                res += "WND, "
         res += "seq={}, ".format(self.seq)
         res += "ack={}, ".format(self.ack)
 
@@ -1,14 +1,36 @@
+import hashlib
+import hmac
+import os
 from datetime import datetime
 from queue import Queue
-from threading import Thread, currentThread
+from threading import Condition, Lock, Thread, currentThread
 from enum import Enum, auto
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
+from fec import Codec
 from packet import Packet
 
 from udp import UDPsocket
 
 Address = Tuple[str, int]
 
+# the first payload byte of SYN and SYN-ACK packets
+SYN_PLAIN = b'\xAC'
+# SYN: asks for a fast open cookie, SYN-ACK: a cookie follows, data on the SYN was not accepted
+SYN_COOKIE = b'\xAD'
+# SYN: a cookie and data follow, SYN-ACK: the data was accepted
+SYN_DATA = b'\xAE'
+cookie_size = 8
+
+# fast open cookies given to this process by servers
+cookies: Dict[Address, bytes] = {}
+
+# streams send their data in packets of at most this many bytes, taking turns
+chunk_size = 8 * 1024
+# bytes a stream may send beyond what the peer application has read
+stream_window = 64 * 1024
+# stream IDs are two bytes on the wire
+max_stream_id = 0xFFFF
+
 
 class State(Enum):
     CLOSED = auto()
@@ -42,37 +64,55 @@ class StateMachine(Thread):
             for packet, send_time in sending:
                 if conn.seq >= packet.seq + packet.LEN:
                     continue
-                if now - send_time >= 1.0:
+                if now - send_time >= conn.rto:
+                    conn.retries += 1
                     print(conn.state, "retransmit ", end='')
                     conn.send_packet(packet)
                 else:
                     conn.sending.append((packet, send_time))
 
+            # the peer is gone, e.g. a FIN or the last ACK of a closed peer was lost for good
+            if conn.retries > conn.max_retries:
+                print(conn.state, "give up")
+                conn.state = State.CLOSED
+                conn.on_peer_closed()
+                conn.close_connection()
+                continue
+
             # close
-            if conn.state == State.TIME_WAIT and no_packet >= 6:
+            if conn.state == State.TIME_WAIT and no_packet * conn.poll >= conn.time_wait:
                 conn.state = State.CLOSED
                 print(conn.state)
                 conn.close_connection()
 
-            # send data
-            if len(conn.receive.queue) == 0 and len(conn.sends.queue) != 0 and \
-                    len(conn.sending) == 0 and no_packet >= 3 and conn.state in (State.ESTABLISHED, State.FIN_WAIT_1):
-                data = conn.sends.get()
+            # send data, after a fast open the reply does not wait for the handshake to complete
+            in_flight = len(conn.sending) != 0 and not (conn.fast_opened and all(it.SYN for it, _ in conn.sending))
+            states = (State.SYN_RCVD, State.ESTABLISHED, State.FIN_WAIT_1) if conn.fast_opened else \
+                (State.ESTABLISHED, State.FIN_WAIT_1)
+            if len(conn.receive.queue) == 0 and conn.pending() and \
+                    not in_flight and no_packet >= conn.send_idle and conn.state in states:
+                data = conn.next_data()
+                seq = conn.next_seq()
                 if isinstance(data, Packet):
-                    to_send = Packet.create(conn.seq, conn.ack, data.payload, SYN=data.SYN, ACK=data.ACK, FIN=data.FIN)
+                    to_send = Packet.create(seq, conn.ack, data.payload, SYN=data.SYN, ACK=data.ACK, FIN=data.FIN,
+                                            stream=data.stream, END=data.END, WND=data.WND)
                 else:
-                    to_send = Packet.create(conn.seq, conn.ack, data)
+                    to_send = Packet.create(seq, conn.ack, data)
                 print(conn.state, "send ", end='')
                 conn.send_packet(to_send)
 
             # receive date
             packet: Packet
             try:
-                packet = conn.receive.get(timeout=0.5)
-                no_packet = 0
+                packet = conn.receive.get(timeout=conn.poll)
             except:
                 no_packet += 1
                 continue
+            # woken up to send
+            if packet is None:
+                continue
+            no_packet = 0
+            conn.retries = 0
 
             print(conn.state, "recv", packet)
 
@@ -89,23 +129,25 @@ class StateMachine(Thread):
                 conn.ack = max(conn.ack, packet.seq + packet.LEN)
 
             not_arrive = [it for (it, send_time) in conn.sending if conn.seq < it.seq + it.LEN]
-            all_packet_arrive = len(conn.sends.queue) == 0 and len(not_arrive) == 0
+            all_packet_arrive = not conn.unsent() and len(not_arrive) == 0
 
             if conn.state == State.CLOSED and packet.SYN:
                 conn.state = State.SYN_RCVD
                 print(conn.state, "send ", end='')
-                conn.send_packet(Packet.create(conn.seq, conn.ack, b'\xAC', SYN=True, ACK=True))
+                conn.send_packet(Packet.create(conn.seq, conn.ack, conn.accept_syn(packet), SYN=True, ACK=True))
             elif conn.state == State.SYN_SENT and packet.SYN:
+                conn.on_syn_ack(packet)
                 conn.state = State.ESTABLISHED
                 print(conn.state, "send ", end='')
                 conn.send_packet(Packet.create(conn.seq, conn.ack, ACK=True))
             elif conn.state == State.SYN_RCVD and packet.ACK:
-                assert packet.ack == 1
                 conn.state = State.ESTABLISHED
             # close
             elif conn.state == State.ESTABLISHED and packet.FIN:
                 conn.send_packet(Packet.create(conn.seq, conn.ack, ACK=True))
                 conn.state = State.CLOSE_WAIT
+                # recv returns b'' from now on
+                conn.on_peer_closed()
                 if all_packet_arrive:
                     conn.send_packet(Packet.create(conn.seq, conn.ack, b'\xAF', FIN=True, ACK=True))
                     conn.state = State.LAST_ACK
@@ -126,11 +168,119 @@ class StateMachine(Thread):
                 conn.close_connection()
 
             elif packet.LEN != 0:
-                conn.message.put(packet)
+                conn.deliver(packet)
                 print(conn.state, "send ", end='')
                 conn.send_packet(Packet.create(conn.seq, conn.ack, ACK=True))
 
 
+class Stream:
+    """
+    One of the byte streams multiplexed over a Connection, opened by either
+    side. Streams share the connection's handshake, sequence numbers and
+    retransmission timer, but each has its own order and receive buffer, so
+    a large transfer on one does not hold up the others: data goes out in
+    packets of at most `chunk_size` bytes, and the streams with something
+    to send take turns.
+
+    A stream sends no more than `stream_window` bytes beyond what the peer
+    application has read, the peer raises that limit as it reads.
+    """
+
+    def __init__(self, conn: 'Connection', stream_id: int):
+        self.conn = conn
+        self.id = stream_id
+        self.lock = Lock()
+        self.readable = Condition(self.lock)
+
+        # sending, `peer_limit` is the stream offset the peer lets us send up to
+        self.out = bytearray()
+        self.sent = 0
+        self.peer_limit = stream_window
+        self.closing = False
+        self.end_sent = False
+        self.window_update: Optional[int] = None
+
+        # receiving
+        self.buffer = bytearray()
+        self.consumed = 0
+        self.limit = stream_window
+        self.ended = False
+
+    def send(self, data: bytes) -> int:
+        with self.lock:
+            assert not self.closing
+            self.out += data
+        self.conn.wake()
+        return len(data)
+
+    def recv(self, bufsize: int) -> bytes:
+        """Up to `bufsize` bytes, b'' once the peer closed the stream and everything was read."""
+        with self.readable:
+            while not self.buffer and not self.ended:
+                self.readable.wait()
+            data = bytes(self.buffer[:bufsize])
+            del self.buffer[:bufsize]
+            self.consumed += len(data)
+            update = not self.ended and self.limit - self.consumed <= stream_window // 2
+            if update:
+                self.limit = self.window_update = self.consumed + stream_window
+        if update:
+            self.conn.wake()
+        return data
+
+    def close(self):
+        """No more data is sent on the stream, the peer reads b'' after what was sent before."""
+        with self.lock:
+            self.closing = True
+        self.conn.wake()
+
+    def sendable(self) -> bool:
+        return self.window_update is not None or (len(self.out) != 0 and self.sent < self.peer_limit) or \
+            (self.closing and len(self.out) == 0 and not self.end_sent)
+
+    def unsent(self) -> bool:
+        return self.window_update is not None or len(self.out) != 0 or (self.closing and not self.end_sent)
+
+    def next_frame(self) -> Packet:
+        """The next packet of the stream, window updates go first, the end after all data."""
+        with self.lock:
+            if self.window_update is not None:
+                limit = self.window_update
+                self.window_update = None
+                return Packet.create(data=int.to_bytes(limit, 4, byteorder='big'), stream=self.id, WND=True)
+            if len(self.out) != 0:
+                size = min(chunk_size, self.peer_limit - self.sent)
+                data = bytes(self.out[:size])
+                del self.out[:size]
+                self.sent += len(data)
+                return Packet.create(data=data, stream=self.id)
+            self.end_sent = True
+            done = self.ended
+        if done:
+            self.conn.forget(self)
+        return Packet.create(data=b'\xAF', stream=self.id, END=True)
+
+    def on_packet(self, packet: Packet):
+        with self.readable:
+            if packet.WND:
+                self.peer_limit = max(self.peer_limit, int.from_bytes(packet.payload, byteorder='big'))
+            elif packet.END:
+                self.ended = True
+            else:
+                self.buffer += packet.payload
+            self.readable.notify_all()
+            done = self.ended and self.end_sent
+        if packet.WND:
+            self.conn.wake()
+        if done:
+            self.conn.forget(self)
+
+    def on_closed(self):
+        with self.readable:
+            self.ended = True
+            self.readable.notify_all()
+
+
 class Connection:
     def __init__(self, client: Address, socket):
         self.client = client
@@ -144,10 +294,40 @@ class Connection:
         self.message: Queue[Packet] = Queue()
         self.sending: List[Tuple[Packet, float]] = []
 
+        # timers, in fast open mode the state machine polls often and sends as soon as it can
+        self.fast = socket.fast_open
+        self.rto = 0.2 if self.fast else 1.0
+        self.poll = 0.01 if self.fast else 0.5
+        # idle polls before data is sent
+        self.send_idle = 0 if self.fast else 3
+        # TIME_WAIT ends after this many quiet seconds, enough to answer a retransmitted FIN
+        self.time_wait = 2 * self.rto if self.fast else 3.0
+        # retransmissions without hearing from the peer before the connection is dropped
+        self.retries = 0
+        self.max_retries = 30
+
+        # the SYN of a fast open client waits for the data of the first send
+        self.syn_pending = False
+        self.fast_open_data = b''
+        self.fast_opened = False
+
+        # FEC datagrams from the peer are always decoded, packets are only sent coded with fec on
+        self.codec = Codec()
+
+        # streams by ID, the connection's own sends and recvs are stream 0
+        self.streams: Dict[int, Stream] = {}
+        self.streams_lock = Lock()
+        self.incoming: Queue[Optional[Stream]] = Queue()
+        self.opened_streams = 0
+        self.peer_streams = 0
+        self.turn = 0
+
         self.machine = StateMachine(self)
         self.machine.start()
 
     def recv(self, bufsize: int, flags: int = ...) -> bytes:
+        if self.syn_pending:
+            self.open()
         return self.message.get().payload
 
     def send(self, data: bytes, flags: int = ...) -> int:
@@ -155,19 +335,182 @@ class Connection:
                                   State.FIN_WAIT_1, State.FIN_WAIT_2, State.CLOSE_WAIT,
                                   State.TIME_WAIT, State.LAST_ACK)
         print("push", len(data), "bytes")
-        self.sends.put(data)
+        if self.syn_pending:
+            self.open(data)
+        else:
+            self.sends.put(data)
+            self.wake()
         return len(data)
 
     def close(self) -> None:
-        assert self.state in (State.SYN_RCVD, State.ESTABLISHED)
+        # the peer closed first, our FIN goes out once everything was sent
+        if self.state in (State.CLOSE_WAIT, State.LAST_ACK, State.CLOSED):
+            return
+        if self.syn_pending:
+            self.open()
+        assert self.state in (State.SYN_SENT, State.SYN_RCVD, State.ESTABLISHED)
         self.sends.put(Packet.create(data=b'\xAF', FIN=True))
         self.state = State.FIN_WAIT_1
 
+    def open(self, data: bytes = b''):
+        """Send the SYN, carrying `data` when the server gave this process a cookie before."""
+        self.syn_pending = False
+        cookie = cookies.get(self.client) if self.fast else None
+        if cookie is None:
+            payload = SYN_COOKIE if self.fast else SYN_PLAIN
+            if data:
+                self.sends.put(data)
+        else:
+            payload = SYN_DATA + cookie + data
+            self.fast_open_data = data
+        self.send_packet(Packet.create(self.seq, self.ack, payload, SYN=True))
+
+    def accept_syn(self, packet: Packet) -> bytes:
+        """Payload of the SYN-ACK, data on the SYN is delivered when its cookie is valid."""
+        marker = packet.payload[:1]
+        if not self.fast or marker not in (SYN_COOKIE, SYN_DATA):
+            return SYN_PLAIN
+
+        cookie = self.socket.cookie(self.client)
+        if marker == SYN_DATA and hmac.compare_digest(packet.payload[1:1 + cookie_size], cookie):
+            self.fast_opened = True
+            data = packet.payload[1 + cookie_size:]
+            if data:
+                self.message.put(Packet.create(data=data))
+            return SYN_DATA
+        return SYN_COOKIE + cookie
+
+    def on_syn_ack(self, packet: Packet):
+        marker = packet.payload[:1]
+        if marker == SYN_COOKIE and packet.LEN == 1 + cookie_size:
+            cookies[self.client] = packet.payload[1:]
+        elif marker == SYN_PLAIN:
+            cookies.pop(self.client, None)
+
+        # data the server did not accept on the SYN is sent again as usual, before anything else
+        if marker != SYN_DATA and self.fast_open_data:
+            with self.sends.mutex:
+                self.sends.queue.appendleft(self.fast_open_data)
+        self.fast_open_data = b''
+
+    def open_stream(self) -> Stream:
+        """
+        A new stream to the peer. IDs are never reused, the peer tells new
+        streams from finished ones by them, so a connection opens at most
+        about 32k streams and raises OSError after that.
+        """
+        with self.streams_lock:
+            # as in QUIC the low bit tells who opened a stream, so both sides can open them
+            stream_id = (self.opened_streams + 1) * 2 - (1 if self.socket.connection is self else 0)
+            if stream_id > max_stream_id:
+                raise OSError('no stream IDs left on this connection')
+            self.opened_streams += 1
+            stream = Stream(self, stream_id)
+            self.streams[stream.id] = stream
+        return stream
+
+    def accept_stream(self) -> Optional[Stream]:
+        """The next stream the peer opened, None once the connection is closed."""
+        return self.incoming.get()
+
+    def forget(self, stream: Stream):
+        with self.streams_lock:
+            self.streams.pop(stream.id, None)
+
+    def deliver(self, packet: Packet):
+        if packet.stream == 0:
+            self.message.put(packet)
+            return
+        # streams the client opens are odd, those of the server even
+        peer_parity = 0 if self.socket.connection is self else 1
+        with self.streams_lock:
+            stream = self.streams.get(packet.stream)
+            # opening a stream opens those the peer numbered before it too, so a late
+            # packet of a stream that is done is not taken for a new one
+            count = (packet.stream + 1) // 2
+            if stream is None and packet.stream % 2 == peer_parity and count > self.peer_streams:
+                for i in range(self.peer_streams + 1, count + 1):
+                    opened = Stream(self, 2 * i - peer_parity)
+                    self.streams[opened.id] = opened
+                    self.incoming.put(opened)
+                self.peer_streams = count
+                stream = self.streams[packet.stream]
+        if stream is not None:
+            stream.on_packet(packet)
+
+    def on_peer_closed(self):
+        self.message.put(Packet())
+        self.incoming.put(None)
+        with self.streams_lock:
+            streams = list(self.streams.values())
+        for stream in streams:
+            stream.on_closed()
+
+    def wake(self):
+        # the state machine only polls every 10 ms in fast mode, and waits for idle polls otherwise
+        if self.fast:
+            self.receive.put(None)
+
+    def pending(self) -> bool:
+        """Whether there is something to send now, stream data only while the peer's window has room."""
+        return len(self.sources()) != 0
+
+    def unsent(self) -> bool:
+        if len(self.sends.queue) != 0:
+            return True
+        with self.streams_lock:
+            return any(it.unsent() for it in self.streams.values())
+
+    def sources(self) -> List[Optional[Stream]]:
+        """
+        The streams that can send now, and None for the connection's own
+        sends. The FIN of the connection waits until no stream has anything
+        left to send, also data held back by the peer's window.
+        """
+        with self.streams_lock:
+            streams = list(self.streams.values())
+        sources: List[Optional[Stream]] = [it for it in streams if it.sendable()]
+        with self.sends.mutex:
+            head = self.sends.queue[0] if len(self.sends.queue) != 0 else None
+        if head is not None and not (isinstance(head, Packet) and head.FIN and any(it.unsent() for it in streams)):
+            sources.append(None)
+        return sources
+
+    def next_data(self):
+        """What to send next, the sources take turns."""
+        sources = self.sources()
+        source = sources[self.turn % len(sources)]
+        self.turn += 1
+        if source is None:
+            return self.sends.get()
+        return source.next_frame()
+
+    def next_seq(self) -> int:
+        return max([self.seq] + [it.seq + it.LEN for it, _ in self.sending])
+
     def send_packet(self, packet: Packet):
         print(packet)
-        self.socket.sendto(packet.to_bytes(), self.client)
+        if self.socket.fec:
+            self.socket.sendto(self.codec.encode(packet.to_bytes()), self.client)
+        else:
+            self.socket.sendto(packet.to_bytes(), self.client)
         self.sending.append((packet, datetime.now().timestamp()))
 
+    def on_recv_data(self, data: bytes):
+        try:
+            packet = Packet.from_bytes(data)
+        except AssertionError:
+            # an FEC datagram, or a corrupted plain one that is dropped
+            data = self.codec.decode(data)
+            if data is None:
+                return
+            try:
+                packet = Packet.from_bytes(data)
+            except AssertionError:
+                self.codec.failed()
+                return
+        self.on_recv_packet(packet)
+
     def on_recv_packet(self, packet: Packet):
         self.receive.put(packet)
 
@@ -179,8 +522,22 @@ class Connection:
 
 # import provided class
 class socket(UDPsocket):
-    def __init__(self):
-        super(socket, self).__init__()
+    def __init__(self, fast_open: bool = False, fec: bool = False, **channel):
+        """
+        With `fast_open`, a client sends the data of its first send on the SYN
+        once a server gave it a cookie, so a short request is answered within
+        one round trip, and a server accepts such data. With `fec`, packets are
+        sent Reed-Solomon coded, so that the peer fixes a datagram with a few
+        corrupted bytes instead of waiting for it to be retransmitted.
+        `channel` is passed to UDPsocket to set the simulated loss, corruption
+        and delay.
+        """
+        super(socket, self).__init__(**channel)
+        # a real timeout, so that the receiving threads notice when the socket is closed
+        super(UDPsocket, self).settimeout(0.5)
+        self.fast_open = fast_open
+        self.fec = fec
+        self.secret = os.urandom(16)
         self.state = State.CLOSED
         self.receiver = None
 
@@ -199,8 +556,7 @@ class socket(UDPsocket):
             while conn.receive_data:
                 try:
                     data, addr = self.recvfrom(10 * 1024 * 1024)
-                    packet = Packet.from_bytes(data)
-                    conn.on_recv_packet(packet)
+                    conn.on_recv_data(data)
                 except:
                     pass
 
@@ -208,7 +564,10 @@ class socket(UDPsocket):
         self.receiver.start()
 
         conn.state = State.SYN_SENT
-        conn.send_packet(Packet.create(conn.seq, conn.ack, b'\xAC', SYN=True))
+        if self.fast_open and address in cookies:
+            conn.syn_pending = True
+        else:
+            conn.open()
 
     def accept(self):  # receive syn; send syn, ack; receive ack    # your code here
         assert self.state in (State.CLOSED, State.LISTEN)
@@ -222,8 +581,7 @@ class socket(UDPsocket):
                         conn = Connection(addr, self)
                         self.connections[addr] = conn
                         self.unhandled_conns.put(conn)
-                    packet = Packet.from_bytes(data)
-                    self.connections[addr].on_recv_packet(packet)
+                    self.connections[addr].on_recv_data(data)
                 except:
                     pass
 
@@ -239,6 +597,14 @@ class socket(UDPsocket):
         assert self.connection
         return self.connection.recv(bufsize, flags)
 
+    def open_stream(self) -> Stream:
+        assert self.connection
+        return self.connection.open_stream()
+
+    def accept_stream(self) -> Optional[Stream]:
+        assert self.connection
+        return self.connection.accept_stream()
+
     def send(self, data: bytes, flags: int = ...) -> int:
         assert self.connection
         return self.connection.send(data, flags)
@@ -253,6 +619,10 @@ class socket(UDPsocket):
         else:
             raise Exception("Illegal state")
 
+    def cookie(self, address: Address) -> bytes:
+        # bound to the client host only, its port changes with every connection
+        return hmac.new(self.secret, address[0].encode(), hashlib.sha256).digest()[:cookie_size]
+
     def _close_connection(self, conn) -> None:
         if self.connection:  # client
             UDPsocket.close(self)
@@ -262,3 +632,56 @@ class socket(UDPsocket):
                 UDPsocket.close(self)
         else:
             raise Exception("Illegal state")
+
+
+class ConnectionPool:
+    """
+    Client connections kept open per server, so a series of requests pays
+    for one handshake. A connection is reused when its last request got a
+    reply, up to `max_idle` are kept per server.
+    """
+
+    def __init__(self, max_idle: int = 4, fast_open: bool = True, **channel):
+        self.max_idle = max_idle
+        self.fast_open = fast_open
+        self.channel = channel
+        self.idle: Dict[Address, List[socket]] = {}
+        self.lock = Lock()
+
+    def acquire(self, address: Address) -> socket:
+        with self.lock:
+            idle = self.idle.get(address, [])
+            while idle:
+                sock = idle.pop()
+                if sock.connection.state == State.ESTABLISHED:
+                    return sock
+                sock.close()
+        sock = socket(self.fast_open, **self.channel)
+        sock.connect(address)
+        return sock
+
+    def release(self, address: Address, sock: socket):
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+            if len(idle) < self.max_idle and sock.connection.state == State.ESTABLISHED:
+                idle.append(sock)
+                return
+        sock.close()
+
+    def request(self, address: Address, data: bytes, bufsize: int = 10 * 1024 * 1024) -> bytes:
+        """Send one message and wait for the reply, b'' when the server closed the connection instead."""
+        sock = self.acquire(address)
+        sock.send(data)
+        reply = sock.recv(bufsize)
+        if reply:
+            self.release(address, sock)
+        else:
+            sock.close()
+        return reply
+
+    def close(self):
+        with self.lock:
+            idle = [it for socks in self.idle.values() for it in socks]
+            self.idle.clear()
+        for sock in idle:
+            sock.close()
@@ -1,7 +1,7 @@
 from rdt import socket
 
 if __name__ == "__main__":
-    server = socket()
+    server = socket(fast_open=True)
     server.bind(('0.0.0.0', 8888))
     while True:
         conn, client = server.accept()
@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from fec import Codec, decode_block, encode_block, header_size
+
+
+def corrupt(block: bytes, length: int, t: int, errors: int, rng: random.Random) -> bytes:
+    """`block` with `errors` wrong symbols in every one of its interleaved codewords."""
+    m = max(1, -(-length // (255 - 2 * t)))
+    n = len(block) // m
+    block = bytearray(block)
+    for c in range(m):
+        for j in rng.sample(range(n), errors):
+            block[j * m + c] ^= rng.randrange(1, 256)
+    return bytes(block)
+
+
+@pytest.mark.parametrize('t', [0, 1, 3, 8])
+@pytest.mark.parametrize('length', [1, 100, 251, 1000, 5000])
+def test_round_trip(length, t):
+    data = random.Random(length).randbytes(length)
+    assert decode_block(encode_block(data, t), length, t) == (data, 0)
+
+
+@pytest.mark.parametrize('t', [1, 3, 8])
+@pytest.mark.parametrize('length', [100, 1000, 5000])
+def test_fixes_up_to_t_errors(length, t):
+    rng = random.Random(length * t)
+    data = rng.randbytes(length)
+    block = encode_block(data, t)
+    for errors in range(1, t + 1):
+        assert decode_block(corrupt(block, length, t, errors, rng), length, t) == (data, errors)
+
+
+# with little parity t + 1 errors are often miscorrected into another codeword, the checksum of rdt catches those
+@pytest.mark.parametrize('t', [3, 8])
+def test_too_many_errors(t):
+    rng = random.Random(t)
+    data = rng.randbytes(1000)
+    block = encode_block(data, t)
+    assert decode_block(corrupt(block, 1000, t, t + 1, rng), 1000, t) == (None, t + 1)
+
+
+def test_wrong_size():
+    assert decode_block(encode_block(b'data', 2)[:-1], 4, 2) == (None, 3)
+
+
+def test_codec():
+    rng = random.Random(0)
+    sender, receiver = Codec(t=4), Codec()
+    data = rng.randbytes(3000)
+    datagram = sender.encode(data)
+    assert receiver.decode(datagram) == data
+
+    header = corrupt(datagram[:header_size], 7, 3, 3, rng)
+    body = corrupt(datagram[header_size:], len(data), 4, 2, rng)
+    assert receiver.decode(header + body) == data
+    # the receiver asks for the parity it needed so far
+    assert receiver.hint() == 2
+
+    # and the sender switches to it once it hears from the receiver
+    assert sender.decode(receiver.encode(b'ack')) == b'ack'
+    assert sender.t == 2
+
+
+def test_codec_rejects_other_datagrams():
+    assert Codec().decode(b'\x01' * 64) is None
@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import rdt
+from udp import UDPsocket
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+clean = dict(loss_rate=0, corruption_rate=0, delay_rate=0)
+
+# serves one connection on a free port and prints the port, reads its first stream once told to on stdin,
+# prints how many bytes it got and exits when stdin is closed, all on stderr
+slow_reader = '''
+import contextlib, io, os, sys
+import rdt
+with contextlib.redirect_stdout(io.StringIO()):
+    server = rdt.socket(fast_open=True, loss_rate=0, corruption_rate=0, delay_rate=0)
+    server.bind(('127.0.0.1', 0))
+    print(server.getsockname()[1], file=sys.stderr, flush=True)
+    conn, _ = server.accept()
+    stream = conn.accept_stream()
+    sys.stdin.readline()
+    received = 0
+    while True:
+        data = stream.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+    print(received, file=sys.stderr, flush=True)
+    # until the client saw the end of the stream and the FIN acknowledged
+    sys.stdin.read()
+os._exit(0)
+'''
+
+
+def wait_for(condition, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_close_waits_for_stream_blocked_by_window():
+    server = subprocess.Popen([sys.executable, '-c', slow_reader], cwd=here,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        port = int(server.stderr.readline())
+        client = rdt.socket(fast_open=True, **clean)
+        client.connect(('127.0.0.1', port))
+        stream = client.open_stream()
+        data = b'x' * 300000
+        stream.send(data)
+        stream.close()
+        # the peer does not read yet, so most of the stream is held back by its window
+        assert stream.unsent()
+        client.close()
+
+        server.stdin.write(b'read\n')
+        server.stdin.flush()
+        assert int(server.stderr.readline()) == len(data)
+        wait_for(lambda: client.connection.state in (rdt.State.FIN_WAIT_2, rdt.State.TIME_WAIT, rdt.State.CLOSED))
+        server.stdin.close()
+        server.wait(timeout=10)
+    finally:
+        server.kill()
+
+
+def test_stream_ids_run_out():
+    sock = rdt.socket(**clean)
+    sock.connection = rdt.Connection(('127.0.0.1', 9), sock)
+    # the client opens the odd IDs, the last one fits in the two bytes of the header
+    sock.connection.opened_streams = (rdt.max_stream_id + 1) // 2 - 1
+    assert sock.open_stream().id == rdt.max_stream_id
+    with pytest.raises(OSError):
+        sock.open_stream()
+    assert len(sock.connection.streams) == 1
+    sock.connection.machine.alive = False
+    sock.connection.wake()
+    UDPsocket.close(sock)